@@ -22,63 +22,124 @@ var PROPERTY_DUPS_SKIP = "dups_skip"; // comma-separated header list
 // Recommend setting to "EventDate,EventTime" for Influence sheet.
 var DUPS_SKIP_DEFAULT = ["EventDate","EventTime"];
  
+// Script cache used to hold the header layout and the duplicate index
+var SCRIPT_CACHE = CacheService.getScriptCache();
+// Seconds the header layout is cached for (re-read after columns are changed)
+var HEADERS_EXPIRY = 600;
+// Seconds an appended row is remembered for duplicate detection (at most 6 hours)
+var DUPS_EXPIRY = 21600;
+ 
 // Expose POST method only
 function doPost(e){
   return handleResponse(e);
 }
 
-// Update the sheet with the values provided in the request
+// Update the sheet with the values provided in the request, either a single
+// row (as parameters) or a batch of rows (as a JSON array in the "rows" parameter)
 function updateSheet(doc, e) {
   // store values in the appropriate sheet
   var sheet = doc.getSheetByName(SHEET_NAME);
+  var rows = [e.parameter];
+  if (typeof e.parameter["rows"] != "undefined") {
+    rows = JSON.parse(e.parameter["rows"]);
+  }
+  return appendRows(sheet, rows);
+}
 
+// Appends the rows that are not duplicates with a single write, returning the
+// index of the last row and the number of rows appended and duplicates skipped
+function appendRows(sheet, rows) {
   // we'll use headers in row 1 to define attributes to retrieve
-  var lastColumn = sheet.getLastColumn();
-  var headers = sheet.getRange(1, 1, 1, lastColumn).getValues()[0];
-  var lastRowIdx = sheet.getLastRow();
-  var nextRowIdx = lastRowIdx+1; // define next row offset
-  var row = [];
-  // loop through the header columns, ignoring undefined entries
-  for (header in headers) {
-    if (typeof e.parameter[headers[header]] != "undefined") {
-      row.push(e.parameter[headers[header]]);
+  var headers = getHeaders(sheet);
+  var values = [];
+  var keys = [];
+  var fingerprints = [];
+  for (var i = 0; i < rows.length; i++) {
+    var row = [];
+    // loop through the header columns, leaving undefined entries empty
+    for (var h = 0; h < headers.length; h++) {
+      var value = rows[i][headers[h]];
+      row.push(typeof value != "undefined" ? value : "");
+    }
+    values.push(row);
+    keys.push(getIndexKey(rows[i]));
+    fingerprints.push(getFingerprint(headers, row));
+  }
+
+  // a row is a duplicate if it matches the last row appended for the same key
+  var latest = getIndex(keys);
+  var appended = [];
+  var appendedIndex = {};
+  for (var i = 0; i < values.length; i++) {
+    if (latest[keys[i]] != fingerprints[i]) {
+      appended.push(values[i]);
+      latest[keys[i]] = appendedIndex[keys[i]] = fingerprints[i];
     }
   }
-    
-  if (!isDuplicate(sheet, headers, lastRowIdx, lastColumn, row)) {
+
+  var lastRowIdx = sheet.getLastRow();
+  if (appended.length > 0) {
     // more efficient to set values as [][] array than individually
-    sheet.getRange(nextRowIdx, 1, 1, row.length).setValues([row]);
-    lastRowIdx = nextRowIdx;
+    sheet.getRange(lastRowIdx+1, 1, appended.length, headers.length).setValues(appended);
+    lastRowIdx += appended.length;
+    if (isCheckingDuplicates()) {
+      SCRIPT_CACHE.putAll(appendedIndex, DUPS_EXPIRY);
+    }
   }
+  return {"row": lastRowIdx, "rows": appended.length, "duplicates": values.length - appended.length};
+}
 
-  return lastRowIdx;
+// Returns the header row, cached to avoid reading it on every request
+function getHeaders(sheet) {
+  var key = "headers:" + SHEET_NAME;
+  var cached = SCRIPT_CACHE.get(key);
+  if (cached) {
+    return JSON.parse(cached);
+  }
+  var headers = sheet.getRange(1, 1, 1, sheet.getLastColumn()).getValues()[0];
+  SCRIPT_CACHE.put(key, JSON.stringify(headers), HEADERS_EXPIRY);
+  return headers;
 }
 
-// Determines whether the new row being added matches the last row in the sheet
-function isDuplicate(sheet, headers, lastRowIdx, lastColumn, row) {
+// Determines whether duplicates are being prevented
+function isCheckingDuplicates() {
   if (SCRIPT_PROP.getProperty(PROPERTY_DUPS)) {
     if (SCRIPT_PROP.getProperty(PROPERTY_DUPS) != "yes") {
       return false; // not preventing duplicates IF specified but not set to "yes"
     }
   }
+  return true;
+}
+
+// Returns the key under which the last row appended for the system and date is indexed
+function getIndexKey(row) {
+  return "dups:" + SHEET_NAME + ":" + row["StarSystem"] + ":" + row["EventDate"];
+}
+
+// Returns a fingerprint of the values of the row, ignoring the skipped headers
+function getFingerprint(headers, row) {
   var skipHeaders = DUPS_SKIP_DEFAULT;
   if (SCRIPT_PROP.getProperty(PROPERTY_DUPS_SKIP)) {
     skipHeaders = SCRIPT_PROP.getProperty(PROPERTY_DUPS_SKIP).split(",");
   }
-  var duplicate = true; // assume duplicate, prove otherwise
-  var lastRowValues = sheet.getRange(lastRowIdx, 1, 1, lastColumn).getValues()[0];
-  // check whether new values match previous row
+  var compared = [];
   for (var i = 0; i < row.length; i++) {
     // have to ignore date fields which do not easily compare
     if (skipHeaders.indexOf(headers[i]) < 0) {
-      if (row[i] != lastRowValues[i]) {
-        duplicate = false;
-        break;
-      }
+      compared.push(String(row[i]));
     }
   }
-  // ideally, should check that all remaining fields are empty string in last row
-  return duplicate;
+  var digest = Utilities.computeDigest(Utilities.DigestAlgorithm.MD5, JSON.stringify(compared), Utilities.Charset.UTF_8);
+  return Utilities.base64Encode(digest);
+}
+
+// Returns the fingerprints of the last rows appended for the keys, using the
+// index held in the cache rather than searching the sheet
+function getIndex(keys) {
+  if (!isCheckingDuplicates() || keys.length == 0) {
+    return {};
+  }
+  return SCRIPT_CACHE.getAll(keys);
 }
 
 function handleResponse(e) {
@@ -101,11 +162,12 @@ function handleResponse(e) {
     // set where we write the data
     var doc = SpreadsheetApp.openById(SCRIPT_PROP.getProperty("key"));
     // update sheet data
-    var nextRow = updateSheet(doc, e);
+    var updated = updateSheet(doc, e);
 
     // return json success results
     return ContentService
-          .createTextOutput(JSON.stringify({"result":"success", "row": nextRow}))
+          .createTextOutput(JSON.stringify({"result":"success", "row": updated.row,
+                                            "rows": updated.rows, "duplicates": updated.duplicates}))
           .setMimeType(ContentService.MimeType.JSON);
   } catch(e){
     // if error return message so that action can be taken
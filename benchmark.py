@@ -0,0 +1,301 @@
+import argparse
+import json
+import random
+import threading
+import time
+import timeit
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+from datetime import datetime as dt
+from module.config import Config
+
+def createLocations(count, rand):
+    """Creates locations scattered through the populated bubble."""
+    locations = []
+    for _ in range(count):
+        d = rand.uniform(10.0, 50.0)
+        locations.append({'x': rand.uniform(-300.0, 300.0), 'y': rand.uniform(-300.0, 300.0),
+            'z': rand.uniform(-300.0, 300.0), 'd': d, 'd2': d**2})
+    return locations
+
+def findLinear(locations, x, y, z):
+    """Equivalent of the original linear scan over all locations."""
+    for location in locations:
+        starDist2 = pow(location['x']-x,2)+pow(location['y']-y,2)+pow(location['z']-z,2)
+        if starDist2 <= location['d2']:
+            return location
+    return None
+
+def benchmarkFilter(args):
+    """Compares the per-event cost of the location filter against location count."""
+    from module.filter import LocationIndex
+    rand = random.Random(args.seed)
+    points = [(rand.uniform(-350.0, 350.0), rand.uniform(-350.0, 350.0), rand.uniform(-350.0, 350.0))
+        for _ in range(args.events)]
+    print "%9s %12s %12s %8s" % ("locations", "linear (us)", "index (us)", "matched")
+    for count in args.locations:
+        locations = createLocations(count, rand)
+        index = LocationIndex(locations)
+        matched = len([point for point in points if index.find(*point) is not None])
+        linear = timeit.timeit(lambda: [findLinear(locations, *point) for point in points], number=args.repeat)
+        indexed = timeit.timeit(lambda: [index.find(*point) for point in points], number=args.repeat)
+        perEvent = 1000000.0 / (args.events * args.repeat)
+        print "%9d %12.2f %12.2f %8d" % (count, linear * perEvent, indexed * perEvent, matched)
+
+# Schemas used for the traffic that isn't a Journal event
+_OTHER_SCHEMAS = [ "https://eddn.edcd.io/schemas/commodity/3", "https://eddn.edcd.io/schemas/outfitting/2",
+    "https://eddn.edcd.io/schemas/shipyard/2" ]
+_OTHER_EVENTS = [ "Docked", "Scan", "FSSDiscoveryScan", "SAASignalsFound", "CarrierJump" ]
+_STATES = [ "None", "Boom", "Expansion", "Election", "War", "CivilWar", "Investment", "Bust" ]
+
+class Generator(object):
+    """Creates compressed EDDN messages resembling the relay traffic."""
+    def __init__(self, args, location):
+        self.args = args
+        self.location = location
+        self.rand = random.Random(args.seed)
+        # Each system has a fixed position, inside the first location for the requested fraction
+        self.systems = [self.createSystem(systemNo) for systemNo in range(args.systems)]
+
+    def createSystem(self, systemNo):
+        location = self.location
+        if self.rand.random() < self.args.inside:
+            radius = location['d'] * self.rand.random()
+        else:
+            radius = location['d'] * self.rand.uniform(1.1, 20.0)
+        (dx, dy, dz) = [self.rand.gauss(0, 1) for _ in range(3)]
+        scale = radius / max((dx*dx+dy*dy+dz*dz)**0.5, 0.001)
+        position = [location['x']+dx*scale, location['y']+dy*scale, location['z']+dz*scale]
+        factions = ["Faction %d-%d" % (systemNo, factionNo) for factionNo in range(self.rand.randint(1, self.args.factions))]
+        return ("Benchmark %d" % systemNo, position, factions)
+
+    def createFactions(self, factions):
+        influences = [self.rand.random() for _ in factions]
+        total = sum(influences)
+        return [{ "Name": name, "Influence": influence / total, "FactionState": self.rand.choice(_STATES),
+            "Allegiance": "Independent", "Government": "Democracy", "Happiness": "$Faction_HappinessBand2;",
+            "PendingStates": [{ "State": self.rand.choice(_STATES), "Trend": 0 }],
+            "RecoveringStates": [] } for (name, influence) in zip(factions, influences)]
+
+    def createMessage(self):
+        (name, position, factions) = self.rand.choice(self.systems)
+        header = { "uploaderID": "%08x" % self.rand.getrandbits(32), "softwareName": "benchmark",
+            "softwareVersion": "1.0", "gatewayTimestamp": dt.utcnow().isoformat() + "Z" }
+        timestamp = dt.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        choice = self.rand.random()
+        if choice < self.args.fsdjump + self.args.location:
+            event = "FSDJump" if choice < self.args.fsdjump else "Location"
+            message = { "event": event, "timestamp": timestamp, "StarSystem": name, "StarPos": position,
+                "SystemFaction": factions[0], "SystemAllegiance": "Independent",
+                "SystemSecurity": "$SYSTEM_SECURITY_medium;", "SystemGovernment": "$government_Democracy;",
+                "SystemEconomy": "$economy_Industrial;", "Population": self.rand.randint(0, 10**9),
+                "Factions": self.createFactions(factions) }
+            schema = "https://eddn.edcd.io/schemas/journal/1"
+        elif choice < self.args.fsdjump + self.args.location + self.args.journal:
+            message = { "event": self.rand.choice(_OTHER_EVENTS), "timestamp": timestamp, "StarSystem": name,
+                "StarPos": position, "BodyName": "%s A 1" % name, "Materials": [{ "Name": "iron", "Percent": 20.0 }] }
+            schema = "https://eddn.edcd.io/schemas/journal/1"
+        else:
+            message = { "timestamp": timestamp, "systemName": name, "stationName": "Station",
+                "commodities": [{ "name": "commodity%d" % n, "buyPrice": n, "sellPrice": n, "stock": n,
+                    "demand": n, "meanPrice": n } for n in range(self.rand.randint(10, 100))] }
+            schema = self.rand.choice(_OTHER_SCHEMAS)
+        return zlib.compress(json.dumps({ "$schemaRef": schema, "header": header, "message": message }))
+
+class SheetHandler(BaseHTTPRequestHandler):
+    """Mimics the responses of Code.gs, with the configured latency and error rate.
+
+    As with Apps Script, the POST is answered by a redirect from which the
+    response is then retrieved by GET.
+    """
+    protocol_version = "HTTP/1.1"
+    # Buffer each response until complete, so that its parts are not held back by
+    #  Nagle's algorithm on the keep-alive connection (waiting on a delayed ACK)
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        form = parse_qs(self.rfile.read(length))
+        time.sleep(self.server.latency)
+        if self.server.rand.random() < self.server.errors:
+            self.respond(500, "text/plain", "Error")
+            return
+        # A batch posts its rows as JSON, otherwise the fields of a single row are posted
+        rows = len(json.loads(form["rows"][0])) if "rows" in form else 1
+        with self.server.lock:
+            self.server.rows += rows
+            row = self.server.rows
+        self.send_response(302)
+        self.send_header("Location", "/echo?row=%d" % row)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        row = int(self.path.split("row=")[-1])
+        self.respond(200, "application/json", json.dumps({ "result": "success", "row": row }))
+
+    def respond(self, status, contentType, body):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # avoid logging every request
+
+class SheetServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StageTimer(object):
+    """Records the latency of each call to the wrapped function."""
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            duration = time.time() - started
+            with self.lock:
+                self.durations.append(duration)
+
+    def report(self):
+        durations = sorted(self.durations)
+        if len(durations) == 0:
+            print "%-16s %8d" % (self.name, 0)
+            return
+        percentile = lambda p: durations[min(int(len(durations) * p), len(durations) - 1)] * 1000000.0
+        print "%-16s %8d %12.1f %10.1f %10.1f %10.1f" % (self.name, len(durations),
+            sum(durations) * 1000000.0 / len(durations), percentile(0.5), percentile(0.99), durations[-1] * 1000000.0)
+
+def _setOption(section, name, value):
+    if not Config.config.has_section(section):
+        Config.config.add_section(section)
+    Config.config.set(section, name, str(value))
+
+def benchmarkEddn(args):
+    """Publishes synthetic EDDN traffic to eddn.main, reporting throughput and stage latency."""
+    import zmq
+    sheetServer = SheetServer(("127.0.0.1", 0), SheetHandler)
+    sheetServer.latency = args.latency / 1000.0
+    sheetServer.errors = args.errors
+    sheetServer.rand = random.Random(args.seed)
+    sheetServer.rows = 0
+    sheetServer.lock = threading.Lock()
+    sheetThread = threading.Thread(target=sheetServer.serve_forever, name="sheet-server")
+    sheetThread.daemon = True
+    sheetThread.start()
+    # Point gurgle at the local relay and sheet before loading the modules that read them
+    relay = "tcp://127.0.0.1:%d" % args.port
+    _setOption("eddn", "relay", relay)
+    _setOption("eddn", "processes", 0)
+    _setOption("metrics", "summary_interval", 0)
+    _setOption("sheet", "url", "http://127.0.0.1:%d/exec" % sheetServer.server_port)
+    _setOption("sheet", "retry_wait", 0)
+    _setOption("cache", "database", ":memory:")
+    _setOption("output", "sinks", "sheet")
+    import eddn
+    from module import filter, influence, sheet
+    from module.metrics import GetCounter
+
+    # Wrap each stage at the point it is called from
+    timers = [StageTimer("processMessage", eddn.processMessage), StageTimer("ConsumeFSDJump", eddn.ConsumeFSDJump),
+        StageTimer("Destinations", influence.DestinationsOrReject),
+        StageTimer("ExtractUpdate", influence.ExtractUpdate), StageTimer("SendUpdate", sheet.SendUpdate),
+        StageTimer("SendUpdates", sheet.SendUpdates)]
+    (eddn.processMessage, eddn.ConsumeFSDJump, influence.DestinationsOrReject, influence.ExtractUpdate,
+        sheet.SendUpdate, sheet.SendUpdates) = timers
+
+    generator = Generator(args, filter._SETTINGS.locations[0])
+    messages = [generator.createMessage() for _ in range(args.messages)]
+    print "Generated %d messages (%.1f MB compressed)" % (len(messages), sum(map(len, messages)) / 1048576.0)
+    publisher = zmq.Context.instance().socket(zmq.PUB)
+    publisher.setsockopt(zmq.SNDHWM, 0)
+    publisher.bind(relay)
+    receiver = threading.Thread(target=eddn.main, name="eddn")
+    receiver.daemon = True
+    receiver.start()
+    time.sleep(1.0) # allow the subscription to be established
+
+    started = time.time()
+    for message in messages:
+        publisher.send(message)
+        if args.rate > 0:
+            time.sleep(1.0 / args.rate)
+    # Wait for the receiver to catch up (or stall)
+    received = -1
+    while received != GetCounter("gurgle_messages_received_total") and received < len(messages):
+        received = GetCounter("gurgle_messages_received_total")
+        time.sleep(1.0)
+    elapsed = time.time() - started
+    sheet.FlushUpdates()
+    flushed = time.time() - started
+
+    print "Received %d of %d messages in %.2fs (%.0f messages/s), sent %d rows in %.2fs" % (
+        received, len(messages), elapsed, received / elapsed, sheetServer.rows, flushed)
+    print "%-16s %8s %12s %10s %10s %10s" % ("stage", "calls", "mean (us)", "p50 (us)", "p99 (us)", "max (us)")
+    for timer in timers:
+        timer.report()
+
+def benchmarkExtract(args):
+    """Measures the per-event cost of extracting, fingerprinting and serialising
+        the snapshot of each (interesting) FSDJump event, without any sending.
+    """
+    _setOption("events", "today_only", "no")
+    from module import filter
+    from module.influence import ExtractUpdate
+    from module.message import DecodeMessage
+    args.fsdjump, args.location, args.journal, args.inside = (1.0, 0.0, 0.0, 1.0)
+    generator = Generator(args, filter._SETTINGS.locations[0])
+    events = [DecodeMessage(zlib.decompress(generator.createMessage()))[1] for _ in range(args.events)]
+    extract = lambda: [ExtractUpdate(event) for event in events]
+    snapshots = [snapshot for snapshot in extract() if snapshot is not None]
+    extracted = min(timeit.repeat(extract, number=1, repeat=args.repeat))
+    serialised = min(timeit.repeat(lambda: [snapshot.toUpdate() for snapshot in snapshots], number=1, repeat=args.repeat))
+    print "%d events, %d snapshots: extract %.2f us/event, serialise %.2f us/snapshot" % (len(events),
+        len(snapshots), extracted * 1000000.0 / len(events), serialised * 1000000.0 / max(len(snapshots), 1))
+
+def main():
+    """Main method that runs the requested benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmarks for gurgle processing stages.")
+    subparsers = parser.add_subparsers()
+    filterParser = subparsers.add_parser("filter", help="per-event location filter cost")
+    filterParser.add_argument("--locations", type=int, nargs="+", default=[1, 10, 50, 100, 500, 1000])
+    filterParser.add_argument("--events", type=int, default=10000)
+    filterParser.add_argument("--repeat", type=int, default=3)
+    filterParser.add_argument("--seed", type=int, default=1)
+    filterParser.set_defaults(func=benchmarkFilter)
+    eddnParser = subparsers.add_parser("eddn", help="throughput of synthetic EDDN traffic through eddn.py")
+    eddnParser.add_argument("--messages", type=int, default=20000, help="number of messages published")
+    eddnParser.add_argument("--rate", type=float, default=0, help="messages published per second (0 is unlimited)")
+    eddnParser.add_argument("--fsdjump", type=float, default=0.04, help="fraction of FSDJump events")
+    eddnParser.add_argument("--location", type=float, default=0.01, help="fraction of Location events")
+    eddnParser.add_argument("--journal", type=float, default=0.35, help="fraction of other journal events")
+    eddnParser.add_argument("--systems", type=int, default=5000, help="number of distinct systems")
+    eddnParser.add_argument("--inside", type=float, default=0.1, help="fraction of systems inside [location]")
+    eddnParser.add_argument("--factions", type=int, default=7, help="maximum factions per system")
+    eddnParser.add_argument("--latency", type=float, default=200, help="sheet response latency (ms)")
+    eddnParser.add_argument("--errors", type=float, default=0.0, help="fraction of sheet requests that fail")
+    eddnParser.add_argument("--port", type=int, default=9510, help="port for the local relay")
+    eddnParser.add_argument("--seed", type=int, default=1)
+    eddnParser.set_defaults(func=benchmarkEddn)
+    extractParser = subparsers.add_parser("extract", help="per-event cost of extracting the system snapshot")
+    extractParser.add_argument("--events", type=int, default=20000)
+    extractParser.add_argument("--systems", type=int, default=5000, help="number of distinct systems")
+    extractParser.add_argument("--factions", type=int, default=7, help="maximum factions per system")
+    extractParser.add_argument("--repeat", type=int, default=5)
+    extractParser.add_argument("--seed", type=int, default=1)
+    extractParser.set_defaults(func=benchmarkExtract)
+    args = parser.parse_args()
+    args.func(args)
+
+# Enable command line execution
+if __name__ == '__main__':
+    main()
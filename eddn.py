@@ -1,65 +1,282 @@
 import zlib
 import zmq
-import json
 import time
+import signal
+import threading
+from os import getpid
+from collections import OrderedDict, deque
+from multiprocessing import Pool
 from module.config import Config
-from module.influence import ConsumeFSDJump
+from module.influence import ConsumeFSDJump, ExtractUpdateOrReject
+from module.sheet import PostUpdate, ResendUpdate
+from module.message import DecodeMessage, CountStage, MessageKey
+from module.metrics import Increment, SetGauge, Describe, StartMetrics, Profiler
+from module.history import StartHistory
+from module.outbox import StartOutbox
+from module.reload import StartReloading
 
-# Configuration specified for the EDDN connection
-__EDDN_RELAY = Config.getString('eddn', 'relay')
+# Configuration specified for the EDDN connection, which may be to several relays
+__EDDN_RELAYS = Config.getString('eddn', 'relay').replace(",", " ").split()
 __EDDN_TIMEOUT = Config.getInteger('eddn', 'timeout', 60000)
 __EDDN_RECONNECT = Config.getInteger('eddn', 'reconnect', 10)
+# Number of recent messages remembered to discard those received from more than one relay
+__EDDN_DEDUPE_WINDOW = Config.getInteger('eddn', 'dedupe_window', 10000)
+# Number of processes decoding messages (0 decodes in the receive loop)
+__EDDN_PROCESSES = Config.getInteger('eddn', 'processes', 0)
+__EDDN_IN_FLIGHT = Config.getInteger('eddn', 'in_flight', 1000)
+# Number of characters of a message logged when it causes an exception
+__EDDN_LOGGED_LENGTH = Config.getInteger('eddn', 'logged_length', 1000)
 
-# Only interested in the Journal Schema ($schemaRef)
-_SCHEMA_REFS = [ "http://schemas.elite-markets.net/eddn/journal/1", "https://eddn.edcd.io/schemas/journal/1" ]
+Describe("gurgle_relay_connected", "Whether each relay is currently connected.")
+Describe("gurgle_relay_reconnects_total", "Disconnections from each relay, after which it is reconnected.")
+Describe("gurgle_messages_duplicate_total", "Messages discarded as already received from another relay.")
 
 def processMessage(message, logger):
     """Processes the specified message, if possible."""
+    Increment("gurgle_bytes_decompressed_total", len(message))
     try:
-        jsonmsg = json.loads(message)
-        if jsonmsg["$schemaRef"] in _SCHEMA_REFS:
-            content = jsonmsg["message"]
-            # Only interested in FSDJump or Location events 
-            if content["event"] in ["FSDJump", "Location"]:
-                ConsumeFSDJump(content)
+        (stage, content) = DecodeMessage(message)
+        CountStage(stage)
+        if content is not None:
+            ConsumeFSDJump(content)
     except Exception:
-        logger.exception('Received message caused unexpected exception, Message: %s' % message)
+        CountStage("errors")
+        logger.exception('Received message caused unexpected exception, Message: %s', _abbreviate(message))
+
+def _abbreviate(message):
+    """Returns the start of the message, for logging."""
+    if len(message) <= __EDDN_LOGGED_LENGTH:
+        return message
+    return "%s... (%d characters)" % (message[0:__EDDN_LOGGED_LENGTH], len(message))
+
+# Generation of the configuration in the receiving process last loaded by a worker process
+_workerGeneration = 0
+
+def _initialiseWorker():
+    global _workerGeneration
+    # Interrupts are handled by the receiving process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Config.synchronousLogging()
+    _workerGeneration = Config.generation
+
+def _reloadWorker(generation):
+    """Reloads the configuration within a worker process once it has been reloaded
+        by the receiving process, as the workers are not replaced.
+    """
+    global _workerGeneration
+    if generation == _workerGeneration:
+        return
+    _workerGeneration = generation
+    try:
+        Config.reload()
+    except Exception:
+        Config.getLogger("eddn").exception('Unable to reload configuration in decoding process %d', getpid())
+
+def _processFrame(frame, keyed, generation):
+    """Decompresses, decodes and filters the frame within a worker process (using
+        the given generation of the configuration), returning the stage reached,
+        the decompressed size, any update to be sent (else the reason the event
+        was rejected, counted by the receiving process) and (if keyed) the key
+        identifying the message.
+    """
+    message = ""
+    key = None
+    _reloadWorker(generation)
+    try:
+        message = zlib.decompress(frame)
+        key = MessageKey(message) if keyed else None
+        (stage, content) = DecodeMessage(message)
+        if content is not None:
+            (extracted, reject) = ExtractUpdateOrReject(content)
+            return (stage, len(message), extracted, reject, key)
+        return (stage, len(message), None, None, key)
+    except Exception:
+        Config.getLogger("eddn").exception('Received message caused unexpected exception, Message: %s',
+            _abbreviate(message))
+        return ("errors", len(message), None, None, key)
+
+class Deduplicator(object):
+    """Remembers the keys of the most recent messages, so that a message received
+        from more than one relay is only processed once.
+    """
+    def __init__(self, window):
+        self.window = max(window, 1)
+        self.keys = set()
+        self.order = deque()
+
+    def isDuplicate(self, key):
+        """Returns True if the key has been seen recently, else remembers it."""
+        if key in self.keys:
+            Increment("gurgle_messages_duplicate_total")
+            return True
+        if len(self.order) >= self.window:
+            self.keys.discard(self.order.popleft())
+        self.keys.add(key)
+        self.order.append(key)
+        return False
+
+class Relay(object):
+    """Subscription to a single relay, which is reconnected in the background
+        (while any others continue to be received) after a timeout or error.
+    """
+    def __init__(self, context, url, timeout, reconnect, logger):
+        self.context = context
+        self.url = url
+        self.timeout = timeout
+        self.reconnect = reconnect
+        self.logger = logger
+        self.socket = None
+        self.lastReceived = 0
+        self.reconnectAt = 0
+
+    def connect(self, poller):
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, "")
+        self.socket.connect(self.url)
+        poller.register(self.socket, zmq.POLLIN)
+        self.lastReceived = time.time()
+        SetGauge("gurgle_relay_connected", 1, { "relay": self.url })
+        self.logger.info('Connected to EDDN at %s', self.url)
+
+    def disconnect(self, poller, reason, exc_info=False):
+        self.logger.warning('Disconnect from EDDN at %s (%s)', self.url, reason, exc_info=exc_info)
+        try:
+            poller.unregister(self.socket)
+            self.socket.close(linger=0)
+        except zmq.ZMQError:
+            pass # already unusable
+        self.socket = None
+        self.reconnectAt = time.time() + self.reconnect
+        SetGauge("gurgle_relay_connected", 0, { "relay": self.url })
+        Increment("gurgle_relay_reconnects_total", labels={ "relay": self.url })
+        self.logger.debug('Reconnecting to EDDN at %s in %d seconds.', self.url, self.reconnect)
+
+    def wait(self, now):
+        """Returns the milliseconds until the relay times out or is to be reconnected."""
+        due = self.reconnectAt if self.socket is None else self.lastReceived + self.timeout / 1000.0
+        return max(int((due - now) * 1000), 0)
+
+class UpdateCollector(object):
+    """Receives the results from the worker processes and posts the updates.
+
+    Results arrive in the order the workers complete them rather than the order
+    the messages were received, so the newest timestamp posted for each system
+    is remembered and any older snapshot of that system is discarded rather than
+    allowed to overwrite the newer one.
+    """
+    def __init__(self, inFlight, deduplicator=None, maxSystems=20000):
+        self.available = threading.BoundedSemaphore(max(inFlight, 1))
+        self.deduplicator = deduplicator
+        self.maxSystems = maxSystems
+        self.latest = OrderedDict()
+        self.logger = Config.getLogger("eddn")
+        self.discards = Config.getRateLimitedLogger("eddn.discards")
+
+    def submit(self, pool, frame):
+        """Hands the frame to the worker pool, blocking if too many are in flight."""
+        self.available.acquire()
+        pool.apply_async(_processFrame, (frame, self.deduplicator is not None, Config.generation),
+            callback=self.collect)
+
+    def collect(self, result):
+        # Executes on the pool result thread, so updates are posted one at a time
+        try:
+            (stage, size, extracted, reject, key) = result
+            if key is not None and self.deduplicator.isDuplicate(key):
+                return
+            Increment("gurgle_bytes_decompressed_total", size)
+            CountStage(stage)
+            if reject is not None:
+                CountStage(reject)
+            if extracted is not None:
+                starName = extracted.starSystem
+                timestamp = extracted.timestamp
+                latest = self.latest.pop(starName, None)
+                if latest is not None and timestamp < latest:
+                    self.discards.debug("Event for %s discarded as older than %s: %s", starName, latest, timestamp)
+                    timestamp = latest
+                else:
+                    PostUpdate(extracted)
+                if len(self.latest) >= self.maxSystems:
+                    self.latest.popitem(last=False)
+                self.latest[starName] = timestamp
+        except Exception:
+            self.logger.exception('Unexpected exception while posting update')
+        finally:
+            self.available.release()
 
 def main():
     """Main method that connects to EDDN and processes messages."""
     logger = Config.getLogger("eddn")
+    # Optionally decode in a pool of processes, leaving this one to receive and send,
+    #  created before the threads started here (and those of ZeroMQ). The logging and
+    #  sink threads are started on import, so each worker replaces the logging locks
+    pool = None
+    if __EDDN_PROCESSES > 0:
+        pool = Pool(__EDDN_PROCESSES, _initialiseWorker)
+        logger.info('Decoding messages using %d processes', __EDDN_PROCESSES)
     context = zmq.Context()
-    subscriber = context.socket(zmq.SUB)
-    subscriber.setsockopt(zmq.SUBSCRIBE, "")
+    # Expose the metrics, record any history, resend any updates left in the outbox,
+    #  reload the configuration on SIGHUP, and allow the loop to be profiled on SIGUSR1
+    StartMetrics()
+    StartHistory()
+    StartOutbox(ResendUpdate)
+    StartReloading()
+    profiler = Profiler()
+    profiler.install()
+    # Messages from more than one relay need to be deduplicated
+    deduplicator = Deduplicator(__EDDN_DEDUPE_WINDOW) if len(__EDDN_RELAYS) > 1 else None
+    collector = UpdateCollector(__EDDN_IN_FLIGHT, deduplicator) if pool is not None else None
 
-    while True:
-        try:
-            subscriber.connect(__EDDN_RELAY)
-            logger.info('Connected to EDDN at %s', __EDDN_RELAY)
-
-            poller = zmq.Poller()
-            poller.register(subscriber, zmq.POLLIN)
-
-            while True:
-                socks = dict(poller.poll(__EDDN_TIMEOUT))
-                if socks:
-                    if socks.get(subscriber) == zmq.POLLIN:
-                        message = subscriber.recv(zmq.NOBLOCK)
-                        message = zlib.decompress(message)
-                        processMessage(message, logger)
-                else:
-                    logger.warning('Disconnect from EDDN (After timeout)')
-                    subscriber.disconnect(__EDDN_RELAY)
-                    break
-
-        except zmq.ZMQError, e:
-            logger.warning('Disconnect from EDDN (After receiving ZMQError)', exc_info=True)
-            subscriber.disconnect(__EDDN_RELAY)
-            logger.debug('Reconnecting to EDDN in %d seconds.' % __EDDN_RECONNECT)
-            time.sleep(__EDDN_RECONNECT)
-        except Exception:
-            logger.critical('Unhandled exception occurred while processing EDDN messages.', exc_info=True)
-            break # exit the main loop
+    poller = zmq.Poller()
+    relays = [Relay(context, url, __EDDN_TIMEOUT, __EDDN_RECONNECT, logger) for url in __EDDN_RELAYS]
+    try:
+        while True:
+            now = time.time()
+            for relay in relays:
+                if relay.socket is None and now >= relay.reconnectAt:
+                    relay.connect(poller)
+            # Wake up periodically while profiling, so the profile is stopped on time,
+            #  and when a relay is due to time out or be reconnected
+            timeout = min([profiler.timeout(__EDDN_TIMEOUT)] + [relay.wait(now) for relay in relays])
+            try:
+                socks = dict(poller.poll(timeout))
+            except zmq.ZMQError:
+                logger.warning('Unable to poll EDDN relays', exc_info=True)
+                socks = {}
+                for relay in relays:
+                    if relay.socket is not None:
+                        relay.disconnect(poller, "After receiving ZMQError")
+            profiler.poll()
+            now = time.time()
+            for relay in relays:
+                if relay.socket is None:
+                    continue
+                if socks.get(relay.socket) != zmq.POLLIN:
+                    if now - relay.lastReceived >= __EDDN_TIMEOUT / 1000.0:
+                        relay.disconnect(poller, "After timeout")
+                    continue
+                relay.lastReceived = now
+                try:
+                    if pool is not None:
+                        frame = relay.socket.recv(zmq.NOBLOCK)
+                    else:
+                        # Decompress directly from the frame to avoid copying the received message
+                        frame = relay.socket.recv(zmq.NOBLOCK, copy=False)
+                except zmq.ZMQError:
+                    relay.disconnect(poller, "After receiving ZMQError", exc_info=True)
+                    continue
+                Increment("gurgle_messages_received_total")
+                if pool is not None:
+                    collector.submit(pool, frame)
+                    continue
+                message = zlib.decompress(buffer(frame))
+                if deduplicator is None or not deduplicator.isDuplicate(MessageKey(message)):
+                    processMessage(message, logger)
+    except Exception:
+        logger.critical('Unhandled exception occurred while processing EDDN messages.', exc_info=True)
+    if pool is not None:
+        pool.terminate()
 
 # Enable command line execution
 if __name__ == '__main__':
@@ -1,22 +1,135 @@
-import json
-import sys
+import argparse
+import bz2
+import gzip
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 from module.config import Config
-from module.influence import ConsumeFSDJump
+from module.clock import UseEventClock
+from module.influence import ExtractUpdateOrReject
+from module.message import DecodeLine, CountStage, STAGES, REJECTS
+from module.sheet import PostUpdate, ResendUpdate, FlushUpdates, Statistics, BlockWhenQueueFull
+from module.history import StartHistory
+from module.outbox import StartOutbox
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("file")
+
+def openFile(fileName):
+    """Opens the file for reading, decompressing gzip or bz2 files by extension."""
+    if fileName.endswith(".gz"):
+        return gzip.open(fileName, "rb")
+    if fileName.endswith(".bz2"):
+        return bz2.BZ2File(fileName, "r")
+    return open(fileName, "r")
+
+def readChunks(file, chunkSize):
+    """Yields lists of (up to) chunkSize lines from the file."""
+    while True:
+        lines = list(islice(file, chunkSize))
+        if len(lines) == 0:
+            break
+        yield lines
+
+def processLines(lines):
+    """Decodes and filters the lines (possibly within a worker process), returning
+        a tuple of the count of lines per stage reached, the count of events per
+        reason rejected by the filter, and the extracted updates.
+    """
+    counts = dict.fromkeys(STAGES + ["errors"], 0)
+    rejects = dict.fromkeys(REJECTS, 0)
+    updates = []
+    for line in lines:
+        try:
+            (stage, content) = DecodeLine(line)
+            counts[stage] += 1
+            if content is not None:
+                (extracted, reject) = ExtractUpdateOrReject(content)
+                if extracted is not None:
+                    updates.append(extracted)
+                else:
+                    rejects[reject] += 1
+        except Exception:
+            counts["errors"] += 1
+            _LOGGER.debug("Unable to process line: %s", line, exc_info=True)
+    return (counts, rejects, updates)
+
+class Replay(object):
+    """Posts the updates extracted from each chunk, reporting on the progress."""
+    def __init__(self, progressInterval):
+        self.counts = dict.fromkeys(STAGES + ["errors"], 0)
+        self.lines = 0
+        self.hits = 0
+        self.started = time.time()
+        self.progressInterval = progressInterval
+        self.nextProgress = self.started + progressInterval
+
+    def collect(self, result):
+        (counts, rejects, updates) = result
+        for stage, count in counts.iteritems():
+            self.counts[stage] += count
+            self.lines += count
+            CountStage(stage, count)
+        for reject, count in rejects.iteritems():
+            if count > 0:
+                CountStage(reject, count)
+        for snapshot in updates:
+            self.hits += 1
+            PostUpdate(snapshot)
+        if self.progressInterval > 0 and time.time() >= self.nextProgress:
+            self.report()
+            self.nextProgress = time.time() + self.progressInterval
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        sheet = Statistics()
+        _LOGGER.info("Processed %d lines in %.1fs (%.0f lines/s): %d events, %d errors, %d hits, %d sent, %d failed, %d cached, %d written",
+            self.lines, elapsed, self.lines / elapsed, self.counts["consumed"], self.counts["errors"],
+            self.hits, sheet["sent"], sheet["failed"], sheet["cached"], sheet["written"])
 
 def main():
-    """Main method that reads file for update."""
-    logger = Config.getLogger("file")
-    fileName = sys.argv[1]
-    logger.info("Reading file: %s", fileName)
+    """Main method that reads files for updates."""
+    parser = argparse.ArgumentParser(description="Reads Journal or EDDN archive files (optionally gzip/bz2) for updates.")
+    parser.add_argument("files", nargs="+", help="files containing Journal events or EDDN messages, one per line")
+    parser.add_argument("--processes", type=int, default=0, help="processes decoding lines (0 decodes in this process)")
+    parser.add_argument("--chunk", type=int, default=5000, help="lines handed to a process at a time")
+    parser.add_argument("--event-clock", action="store_true", help="evaluate dates relative to each event rather than today")
+    parser.add_argument("--progress", type=int, default=10, help="seconds between progress reports (0 disables)")
+    args = parser.parse_args()
+    if args.event_clock:
+        UseEventClock()
+    # Reading the file is held back by the sheet, rather than updates being lost
+    BlockWhenQueueFull()
+    # Create the processes before any sender threads are started
+    pool = Pool(args.processes, Config.synchronousLogging) if args.processes > 0 else None
+    StartHistory()
+    StartOutbox(ResendUpdate)
+    replay = Replay(args.progress)
     try:
-        with open(fileName, "r") as file:
-            for line in file:
-                content = json.loads(line)
-                # Only interested in FSDJump or Location events
-                if content["event"] in ["FSDJump", "Location"]:
-                    ConsumeFSDJump(content)
+        for fileName in args.files:
+            _LOGGER.info("Reading file: %s", fileName)
+            with openFile(fileName) as file:
+                if pool is None:
+                    for lines in readChunks(file, args.chunk):
+                        replay.collect(processLines(lines))
+                    continue
+                # Bound the chunks in flight, collecting them in order
+                pending = deque()
+                for lines in readChunks(file, args.chunk):
+                    pending.append(pool.apply_async(processLines, (lines,)))
+                    if len(pending) >= 2 * args.processes:
+                        replay.collect(pending.popleft().get())
+                while len(pending) > 0:
+                    replay.collect(pending.popleft().get())
+        # Wait for any queued updates to be sent before exiting
+        FlushUpdates()
+        replay.report()
     except:
-        logger.critical('Unexpected exception while processing.', exc_info=True)
+        _LOGGER.critical('Unexpected exception while processing.', exc_info=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 # Enable command line execution
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import argparse
+import time
+from module.config import Config
+from module.history import LoadHistory
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("history")
+
+def formatTime(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+def listSystems(history, args):
+    for system in history.systemNames():
+        print system.encode("utf-8")
+
+def showTrend(history, args):
+    trends = history.trend(args.system.decode("utf-8"))
+    if len(trends) == 0:
+        print "No history for %s" % args.system
+        return
+    for faction in sorted(trends):
+        if args.faction is not None and faction != args.faction.decode("utf-8"):
+            continue
+        print faction.encode("utf-8")
+        for (first, last, influence, state) in trends[faction]:
+            print "  %s  %s  %6.2f%%  %s" % (formatTime(first), formatTime(last), influence * 100, state)
+
+def detectTick(history, args):
+    latest = history.latest()
+    if latest is None:
+        print "No history available"
+        return
+    until = latest - args.offset * 3600
+    tick = history.detectTick(until - args.hours * 3600, until, args.min_systems)
+    if tick is None:
+        print "No tick detected in the %d hours to %s" % (args.hours, formatTime(until))
+        return
+    (after, before, systems) = tick
+    print "Tick between %s and %s (%d systems changed)" % (formatTime(after), formatTime(before), systems)
+
+def main():
+    """Main method that queries the influence history saved by eddn.py or file.py."""
+    parser = argparse.ArgumentParser(description="Queries the influence history (see [history] in gurgle.ini).")
+    parser.add_argument("--file", help="history file to query (defaults to the configured file)")
+    subparsers = parser.add_subparsers()
+    systemsParser = subparsers.add_parser("systems", help="list the systems held")
+    systemsParser.set_defaults(func=listSystems)
+    trendParser = subparsers.add_parser("trend", help="influence and state of the factions in a system")
+    trendParser.add_argument("system")
+    trendParser.add_argument("--faction", help="only show the named faction")
+    trendParser.set_defaults(func=showTrend)
+    tickParser = subparsers.add_parser("tick", help="detect the tick from influence changes across systems")
+    tickParser.add_argument("--hours", type=int, default=24, help="hours of changes considered")
+    tickParser.add_argument("--offset", type=int, default=0, help="hours before the latest data the period ends")
+    tickParser.add_argument("--min-systems", type=int, default=3, help="systems that must agree on the tick")
+    tickParser.set_defaults(func=detectTick)
+    args = parser.parse_args()
+    history = LoadHistory(args.file) if args.file is not None else LoadHistory()
+    args.func(history, args)
+
+# Enable command line execution
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
+from config import Config
+from clock import Today
+from metrics import Increment
+from os.path import splitext
+import hashlib
+import sqlite3
+import threading
 
 # Cache mechanism that attempts to prevent duplicate updates
 #  While ideally we wanted the Google Sheet to prevent duplicates, this is
@@ -7,42 +14,100 @@ from datetime import datetime as dt
 #  the sheet will handle selecting appropriate entries due to complexities such
 #  as the BGS Tick Date and whether we trust data around the tick time which
 #  can change 'on a whim'.
-# This 'cache' is date-keyed, but we enforce only having an entry for today (which
-#  ensures automatic clean-up if we continue to execute over several days).
-# The key (date) maps to a single map which maps System Name to a List of Faction
-#  Influence and State values, which we use to determine if there has been a change
-#  that we need to communicate to the Google Sheet.
-_CACHE_BY_DATE = {}
-
-def IsNotInCache(date, name, value):
-    """Returns True if the specified value does NOT match the cache, else False.
-
-    Note that this cache implementation only ensures that values for the current
-    date are stored and is not a general cache mechanism.
+# This 'cache' is keyed by date and system, but we only retain entries for the
+#  configured number of days up to today (which ensures automatic clean-up if we
+#  continue to execute over several days, while surviving the BGS tick).
+# Each key maps to a fingerprint of the Faction Influence and State values (as
+#  computed for each SystemSnapshot), which
+#  we use to determine if there has been a change that we need to communicate to
+#  the Google Sheet. The cache is held in SQLite so that it survives restarts.
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("cache")
+
+# Configuration for the cache storage (defaults to memory, i.e. not persistent)
+_CACHE_DATABASE = Config.getString('cache', 'database', ':memory:')
+_CACHE_RETENTION = Config.getInteger('cache', 'retention', 1)
+
+
+class FingerprintCache(object):
+    """SQLite backed store of the latest fingerprint sent for each date and system."""
+    def __init__(self, database, retention):
+        self.retention = max(retention, 1)
+        self.lock = threading.Lock()
+        self.oldestDate = None
+        # Shared with the background sender threads, so guarded by our own lock
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fingerprint ("
+            "date TEXT NOT NULL, system TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (date, system))")
+        self.connection.commit()
+
+    def _isRetained(self, date):
+        """Returns True if the date is within the retention period, removing any
+            entries that have fallen outside of the period as the date advances.
+        """
+        todayDate = Today(date)
+        today = dt.strptime(todayDate, "%Y-%m-%d")
+        oldestDate = (today - timedelta(days=self.retention-1)).strftime("%Y-%m-%d")
+        if self.oldestDate is None or oldestDate > self.oldestDate:
+            self.oldestDate = oldestDate
+            purged = self.connection.execute("DELETE FROM fingerprint WHERE date < ?", (oldestDate,)).rowcount
+            self.connection.commit()
+            _LOGGER.debug("Cache retaining entries from %s (purged %d)", oldestDate, purged)
+        return self.oldestDate <= date <= todayDate
+
+    def get(self, date, name):
+        """Returns the fingerprint for the date and system, else None."""
+        with self.lock:
+            if not self._isRetained(date):
+                return None
+            row = self.connection.execute("SELECT value FROM fingerprint WHERE date = ? AND system = ?",
+                (date, name)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, date, name, fingerprint):
+        """Records the fingerprint for the date and system, if being retained."""
+        with self.lock:
+            if self._isRetained(date):
+                self.connection.execute("INSERT OR REPLACE INTO fingerprint (date, system, value) VALUES (?, ?, ?)",
+                    (date, name, fingerprint))
+                self.connection.commit()
+
+_CACHE = FingerprintCache(_CACHE_DATABASE, _CACHE_RETENTION)
+# Caches for the sheets other than the default sheet, by url
+_SHEET_CACHES = {}
+_SHEET_CACHES_LOCK = threading.Lock()
+
+
+def SheetCache(url):
+    """Returns the cache for the sheet url (None for the default sheet), where each
+        other sheet has a database of its own alongside that of the default sheet.
     """
-    # We only ever cache the values for 'today', assuming either the caller
-    #  will reject other dates or requires all updates to flow
-    todayDate = dt.utcnow().strftime("%Y-%m-%d")
-    # If we're provided an item that isn't for today, simply return True
-    if date != todayDate:
-        return True
-    # If the cache doesn't have an entry for today, clear it and add empty
-    if date not in _CACHE_BY_DATE:
-        _CACHE_BY_DATE.clear()
-        _CACHE_BY_DATE[date] = {}
-        return True
-    # Does the cache already have this key?
-    entries = _CACHE_BY_DATE[date]
-    if name not in entries:
-        return True
-    # Need to check if the cache entry matches what we want to send
-    if entries[name] != value:
-        return True
-    # Cache matches specified value
-    return False
-
-def CacheUpdate(date, name, value):
-    """Ensures the cache is updated with the lastest value."""
-    if date in _CACHE_BY_DATE:
-        entries = _CACHE_BY_DATE[date]
-        entries[name] = value
+    if url is None:
+        return _CACHE
+    with _SHEET_CACHES_LOCK:
+        cache = _SHEET_CACHES.get(url)
+        if cache is None:
+            database = _CACHE_DATABASE
+            if database != ":memory:":
+                (root, extension) = splitext(database)
+                database = "%s.%s%s" % (root, hashlib.sha1(url).hexdigest()[0:12], extension)
+            cache = _SHEET_CACHES[url] = FingerprintCache(database, _CACHE_RETENTION)
+        return cache
+
+def IsNotInCache(date, name, fingerprint, cache=_CACHE):
+    """Returns True if the specified fingerprint does NOT match the cache, else False.
+
+    Note that this cache implementation only ensures that values for the
+    retained dates are stored and is not a general cache mechanism.
+    """
+    # Dates outside of the retention period are never cached, assuming either
+    #  the caller will reject other dates or requires all updates to flow
+    isNotInCache = cache.get(date, name) != fingerprint
+    Increment("gurgle_cache_total", labels={ "result": "miss" if isNotInCache else "hit" })
+    return isNotInCache
+
+def CacheUpdate(date, name, fingerprint, cache=_CACHE):
+    """Ensures the cache is updated with the lastest fingerprint."""
+    cache.put(date, name, fingerprint)
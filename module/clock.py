@@ -0,0 +1,18 @@
+"""Provides the current date, either from the wall clock or as of the events being processed."""
+from datetime import datetime as dt
+
+# Determines whether dates are evaluated relative to each event (i.e. replaying)
+_EVENT_CLOCK = False
+
+def UseEventClock(enabled=True):
+    """Evaluates 'today' as the date of each event rather than the wall clock,
+        allowing archived events to be processed as if they were current.
+    """
+    global _EVENT_CLOCK
+    _EVENT_CLOCK = enabled
+
+def Today(eventDate=None):
+    """Returns today's date (UTC) as YYYY-MM-DD, or the event date if using the event clock."""
+    if _EVENT_CLOCK and eventDate is not None:
+        return eventDate
+    return dt.utcnow().strftime("%Y-%m-%d")
@@ -0,0 +1,82 @@
+"""Provides for collapsing bursts of updates for the same system into the latest state."""
+from config import Config
+from metrics import Increment, SetGauge, Describe
+import threading
+import time
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("coalesce")
+
+Describe("gurgle_coalesced_total", "Updates superseded by a later update for the same system.")
+Describe("gurgle_coalesce_pending", "Systems with an update held by the coalescing window.")
+
+
+class Coalescer(object):
+    """Holds the update for each system (and date) until no different update has
+        arrived for the window, or the update has been held for the maximum delay,
+        replacing it with any newer update that arrives while held.
+
+    Only the latest state is then emitted, so that transient changes (such as
+    two commanders reporting slightly different data) are not all sent.
+    """
+    def __init__(self, window, maxDelay, emit):
+        self.window = window
+        self.maxDelay = max(maxDelay, window)
+        self.emit = emit
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Starts the thread emitting the held updates, if not already running."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="coalesce")
+                self.thread.daemon = True
+                self.thread.start()
+                _LOGGER.info("Coalescing updates for %d seconds (at most %d seconds)", self.window, self.maxDelay)
+
+    def offer(self, snapshot):
+        """Holds the snapshot, replacing any older snapshot held for the same system."""
+        self.start()
+        key = (snapshot.eventDate, snapshot.starSystem)
+        now = time.time()
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [now, now, snapshot]
+                SetGauge("gurgle_coalesce_pending", len(self.pending))
+                return
+            held = entry[2]
+            Increment("gurgle_coalesced_total")
+            if snapshot.timestamp < held.timestamp:
+                return # older than the snapshot held, so already superseded
+            if snapshot.fingerprint != held.fingerprint:
+                entry[1] = now # only a different state extends the window
+            entry[2] = snapshot
+
+    def _due(self, force):
+        """Removes and returns the held updates that are due to be emitted."""
+        now = time.time()
+        with self.lock:
+            due = [key for (key, entry) in self.pending.iteritems() if force or
+                now - entry[1] >= self.window or now - entry[0] >= self.maxDelay]
+            entries = [self.pending.pop(key) for key in due]
+            SetGauge("gurgle_coalesce_pending", len(self.pending))
+        return entries
+
+    def _emit(self, force=False):
+        for (_, _, snapshot) in self._due(force):
+            try:
+                self.emit(snapshot)
+            except Exception:
+                _LOGGER.exception("Unexpected exception while emitting update for %s", snapshot.starSystem)
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.window, 1.0))
+            self._emit()
+
+    def flush(self):
+        """Emits all held updates immediately."""
+        self._emit(force=True)
@@ -1,11 +1,15 @@
 """Provides for basic configuration of the system parameters and logging infrastructure."""
+from logqueue import QueueHandler, QueueListener, RateLimitFilter
 import ConfigParser
+import Queue
+import atexit
 import json
 import logging
 import logging.config
 import md5
+import threading
 from os import makedirs
-from os.path import isdir, isfile
+from os.path import isdir, isfile, getmtime
 
 # Defines the file names checked for configuration overrides
 _CONFIG_FILES = ['gurgle-local.ini', 'gurgle.local.ini']
@@ -13,18 +17,66 @@ _CONFIG_FILES = ['gurgle-local.ini', 'gurgle.local.ini']
 _LOG_SECTION = 'logging'
 _LOG_CONFIG = 'config'
 _LOG_DIRECTORY = 'directory'
+# Defines the fields controlling asynchronous logging, and the rate limiting of repetitive messages
+_LOG_ASYNC = 'async'
+_LOG_QUEUE_SIZE = 'queue_size'
+_LOG_RATE_LIMIT = 'rate_limit'
+_LOG_RATE_WINDOW = 'rate_window'
 # Defines a default formatter for the logging framework, if not configured
 _LOG_FORMAT = "%(asctime)-19.19s %(levelname)-5.5s [%(name)s] %(message)s"
 
 class Configuration(object):
     def __init__(self):
-        self.config = ConfigParser.RawConfigParser()
-        self.config.readfp(open('gurgle.ini'))
+        # Functions rebuilding the state of each module when reloaded
+        self.reloaders = []
+        self.logListener = None
+        self.logQueueHandler = None
+        self.rateLimitFilter = None
+        self.generation = 0
+        self.modified = self._modified()
+        self.config = self._read()
+
+    def _read(self):
+        config = ConfigParser.RawConfigParser()
+        config.readfp(open('gurgle.ini'))
         # Check configuration files in preference order
         for filename in _CONFIG_FILES:
             if isfile(filename):
-                self.config.read(filename)
+                config.read(filename)
                 break # first config file found is used
+        return config
+
+    def _modified(self):
+        return [getmtime(filename) if isfile(filename) else None for filename in ['gurgle.ini'] + _CONFIG_FILES]
+
+    def hasChanged(self):
+        """Returns True if any of the configuration files have changed since read."""
+        return self._modified() != self.modified
+
+    def onReload(self, prepare):
+        """Registers the function preparing the state of a module from the reloaded
+            configuration, which returns the function that puts that state in place.
+        """
+        self.reloaders.append(prepare)
+
+    def reload(self):
+        """Re-reads the configuration files and rebuilds the state of each registered
+            module, which is only put in place once all modules have been prepared,
+            leaving the existing configuration in place if any fail.
+        """
+        # The files are not considered changed again until next modified, even on failure
+        self.modified = self._modified()
+        config = self._read()
+        previous = self.config
+        self.config = config
+        try:
+            commits = [prepare() for prepare in self.reloaders]
+        except Exception:
+            self.config = previous
+            raise
+        for commit in commits:
+            commit()
+        self.generation += 1
 
     def initialiseLogging(self):
         # If a directory is specified, we might need to create it
@@ -39,6 +91,41 @@ class Configuration(object):
             logging.config.dictConfig(logDict)
         else:
             logging.basicConfig(format=_LOG_FORMAT)
+        self.rateLimitFilter = RateLimitFilter(self.getInteger(_LOG_SECTION, _LOG_RATE_LIMIT, 10),
+            self.getInteger(_LOG_SECTION, _LOG_RATE_WINDOW, 60))
+        # Move the handlers of the root logger behind a queue, if logging asynchronously
+        if self.getBoolean(_LOG_SECTION, _LOG_ASYNC):
+            root = logging.getLogger()
+            handlers = root.handlers[:]
+            logQueue = Queue.Queue(self.getInteger(_LOG_SECTION, _LOG_QUEUE_SIZE, 10000))
+            for handler in handlers:
+                root.removeHandler(handler)
+            self.logQueueHandler = QueueHandler(logQueue)
+            root.addHandler(self.logQueueHandler)
+            self.logListener = QueueListener(logQueue, *handlers)
+            self.logListener.start()
+            atexit.register(self.logListener.stop)
+
+    def synchronousLogging(self):
+        """Restores the handlers of the root logger, for a forked process which
+            lacks the thread handling the queued records.
+
+        The locks used in logging are also replaced, as any held by another thread
+        when the process was forked would never be released in the forked process.
+        """
+        logging._lock = threading.RLock()
+        if self.rateLimitFilter is not None:
+            self.rateLimitFilter.lock = threading.Lock()
+        root = logging.getLogger()
+        if self.logListener is not None:
+            root.removeHandler(self.logQueueHandler)
+            for handler in self.logListener.handlers:
+                root.addHandler(handler)
+            self.logListener = self.logQueueHandler = None
+        for reference in logging._handlerList:
+            handler = reference()
+            if handler is not None:
+                handler.createLock()
 
     def hasSection(self, section):
         return self.config.has_section(section)
@@ -46,6 +133,15 @@ class Configuration(object):
     def getLogger(self, name):
         return logging.getLogger(name)
 
+    def getRateLimitedLogger(self, name):
+        """Returns the logger for repetitive messages (such as those for each event
+            discarded), which limits how often each message is logged.
+        """
+        logger = logging.getLogger(name)
+        if self.rateLimitFilter not in logger.filters:
+            logger.addFilter(self.rateLimitFilter)
+        return logger
+
     def getString(self, section, name, default=None):
         if self.config.has_option(section, name):
             return self.config.get(section, name)
@@ -1,26 +1,42 @@
-from math import pow
-from datetime import datetime as dt
+from math import floor
+from collections import OrderedDict
 from config import Config
+from clock import Today
+from message import CountStage
 
 # Logger instance used by the functions in this module
 _LOGGER = Config.getLogger("filter")
+_DISCARDS = Config.getRateLimitedLogger("filter.discards")
 
-# Determine if only looking for events today
-_TODAY_ONLY = Config.getBoolean('events', 'today_only', True)
-# Allow specific named systems to be included in the updates
-_INCLUDE_SYSTEM_SET = set()
-_INCLUDE_SYSTEMS = Config.getString('events', 'include_systems')
-if _INCLUDE_SYSTEMS is not None and len(_INCLUDE_SYSTEMS.strip()) > 0:
-    _INCLUDE_SYSTEM_SET.update([system.strip() for system in _INCLUDE_SYSTEMS.split(",")])
-if len(_INCLUDE_SYSTEM_SET) > 0:
-    _LOGGER.info("Configured for systems: %s", ", ".join(_INCLUDE_SYSTEM_SET))
+class Destination(object):
+    """Google Sheet to which the updates for one or more locations are sent, along
+        with the location from which the distance of each system is measured.
+
+    The default destination (the [sheet] section) has no url, and measures the
+    distance from the primary location. Any other location naming its own url
+    (and apikey) is the destination for that url, measuring from that location.
+    """
+    __slots__ = ("name", "url", "apiKey", "x", "y", "z")
+
+    def __init__(self, name, url, apiKey, location):
+        self.name = name
+        self.url = url
+        self.apiKey = apiKey
+        (self.x, self.y, self.z) = (location['x'], location['y'], location['z'])
+
+def _systems(section):
+    systems = Config.getString(section, 'include_systems')
+    if systems is None or len(systems.strip()) == 0:
+        return []
+    return [system.strip() for system in systems.split(",")]
 
 # Interested in activity around specific locations
 def InitialiseLocations():
     """Returns a list of dictionaries that define the volumes within which events
-        should be reported.
+        should be reported, and the destination of the updates for each.
     """
     locations = []
+    destinations = {}
     section = "location"
     sectionNumber = 0
     while Config.hasSection(section):
@@ -28,49 +44,202 @@ def InitialiseLocations():
         locationY = Config.getFloat(section, 'y')
         locationZ = Config.getFloat(section, 'z')
         locationD = Config.getFloat(section, 'distance')
-        locations.append({'x': locationX, 'y': locationY, 'z': locationZ, 'd2': locationD**2})
-        _LOGGER.info("Configured for %.1f LY around %s", locationD, Config.getString(section, 'name'))
+        name = Config.getString(section, 'name')
+        location = {'x': locationX, 'y': locationY, 'z': locationZ, 'd': locationD, 'd2': locationD**2,
+            'name': name, 'systems': _systems(section)}
+        # Locations without their own sheet share the default sheet, measured from the primary location
+        url = Config.getString(section, 'url')
+        if url not in destinations:
+            if url is None:
+                destinations[url] = Destination("sheet", None, None, locations[0] if len(locations) > 0 else location)
+            else:
+                destinations[url] = Destination(name, url, Config.getCrypt(section, 'apikey'), location)
+        location['destination'] = destinations[url]
+        locations.append(location)
+        _LOGGER.info("Configured for %.1f LY around %s%s", locationD, name, " (sent to its own sheet)" if url else "")
         sectionNumber+=1
         section = "location.%d" % sectionNumber
     return locations
-_LOCATIONS = InitialiseLocations()
+
+class LocationIndex(object):
+    """Uniform grid over the location volumes, allowing the locations that could
+        contain a point to be found without checking every location.
+
+    Each location is registered in every cell overlapped by its bounding box, so
+    a point only needs to be checked against the locations in its own cell.
+    The cell size defaults to the largest location radius, which bounds each
+    location to at most 27 cells.
+    """
+    def __init__(self, locations, cellSize=None):
+        if cellSize is None:
+            cellSize = max([location['d'] for location in locations] or [1.0])
+        self.cellSize = max(cellSize, 1.0)
+        self.cells = {}
+        for location in locations:
+            (x, y, z, d) = (location['x'], location['y'], location['z'], location['d'])
+            bounds = (x-d, x+d, y-d, y+d, z-d, z+d)
+            (minX, minY, minZ) = self._cell(bounds[0], bounds[2], bounds[4])
+            (maxX, maxY, maxZ) = self._cell(bounds[1], bounds[3], bounds[5])
+            for cellX in range(minX, maxX+1):
+                for cellY in range(minY, maxY+1):
+                    for cellZ in range(minZ, maxZ+1):
+                        self.cells.setdefault((cellX, cellY, cellZ), []).append((bounds, location))
+
+    def _cell(self, x, y, z):
+        return (int(floor(x / self.cellSize)), int(floor(y / self.cellSize)), int(floor(z / self.cellSize)))
+
+    def find(self, x, y, z):
+        """Returns the first location containing the point, else None."""
+        for location in self._containing(x, y, z):
+            return location
+        return None
+
+    def findAll(self, x, y, z):
+        """Returns the list of locations containing the point."""
+        return list(self._containing(x, y, z))
+
+    def _containing(self, x, y, z):
+        candidates = self.cells.get(self._cell(x, y, z))
+        if candidates is None:
+            return
+        for (bounds, location) in candidates:
+            # Bounding box check is cheaper than the distance calculation
+            if x < bounds[0] or x > bounds[1] or y < bounds[2] or y > bounds[3] or z < bounds[4] or z > bounds[5]:
+                continue
+            dx = location['x']-x
+            dy = location['y']-y
+            dz = location['z']-z
+            if dx*dx+dy*dy+dz*dz <= location['d2']:
+                yield location
+
+class FilterSettings(object):
+    """Settings (and the structures precomputed from them) that determine the
+        events of interest, replaced as a whole when the configuration is reloaded.
+    """
+    def __init__(self):
+        # Determine if only looking for events today
+        self.todayOnly = Config.getBoolean('events', 'today_only', True)
+        self.locations = InitialiseLocations()
+        self.index = LocationIndex(self.locations)
+        self.destinations = []
+        for location in self.locations:
+            if location['destination'] not in self.destinations:
+                self.destinations.append(location['destination'])
+        # Allow specific named systems to be included in the updates, either for
+        #  the default sheet or for the sheet of a location
+        self.includeSystems = {}
+        systems = _systems('events')
+        if len(systems) > 0:
+            default = self._default()
+            for system in systems:
+                self._include(system, default)
+        for location in self.locations:
+            for system in location['systems']:
+                self._include(system, location['destination'])
+        if len(self.includeSystems) > 0:
+            _LOGGER.info("Configured for systems: %s", ", ".join(self.includeSystems))
+        # Remembers the destinations for each system (by name) from the locations
+        #  containing it, up to a maximum number of systems (as systems never move)
+        self.verdicts = OrderedDict()
+        self.systemCacheSize = Config.getInteger('events', 'system_cache', 20000)
+
+    def _default(self):
+        """Returns the destination of the default sheet, measured from the primary
+            location, adding it if no location is sent to the default sheet.
+        """
+        for destination in self.destinations:
+            if destination.url is None:
+                return destination
+        destination = Destination("sheet", None, None, self.locations[0])
+        self.destinations.append(destination)
+        return destination
+
+    def _include(self, system, destination):
+        destinations = self.includeSystems.setdefault(system, [])
+        if destination not in destinations:
+            destinations.append(destination)
+
+_SETTINGS = FilterSettings()
+
+def _reload():
+    settings = FilterSettings()
+    def commit():
+        global _SETTINGS
+        _SETTINGS = settings
+    return commit
+Config.onReload(_reload)
+
+def FindDestination(url):
+    """Returns the configured destination for the sheet url (None for the default
+        sheet), else None if no longer configured.
+    """
+    for destination in _SETTINGS.destinations:
+        if destination.url == url:
+            return destination
+    return None
 
 def IsInteresting(event):
     """Returns True if the FSDJump event (or equivalent subset of Location event)
         provided by Journal is interesting according to the filter configuration.
     """
-    isInterestingSystem = IsInterestingSystem(event)
-    if isInterestingSystem:
-        # Determine if the timestamp is considered relevant
-        # (NOTE: assumption we receive UTC)
-        timestamp = event["timestamp"]
-        eventDate = timestamp[0:10]
-        todayDate = dt.utcnow().strftime("%Y-%m-%d")
-        if _TODAY_ONLY and eventDate != todayDate:
-            starName = event["StarSystem"]
-            _LOGGER.debug("Event for %s discarded as not today: %s", starName, eventDate)
-            return False
-    return isInterestingSystem
+    return len(Destinations(event)) > 0
+
+def Destinations(event):
+    """Returns the tuple of destinations for the FSDJump event (or equivalent
+        subset of Location event) provided by Journal, which is empty unless the
+        event is interesting according to the filter configuration.
+    """
+    (destinations, reject) = DestinationsOrReject(event)
+    if reject is not None:
+        CountStage(reject)
+    return destinations
+
+def DestinationsOrReject(event):
+    """Returns a tuple of the destinations for the event (as for Destinations) and
+        the reason it is rejected if there are none (without counting it, as this
+        may be within a worker process).
+    """
+    settings = _SETTINGS
+    destinations = _destinations(settings, event)
+    if len(destinations) == 0:
+        return ((), "filter_distance")
+    # Determine if the timestamp is considered relevant
+    # (NOTE: assumption we receive UTC)
+    timestamp = event["timestamp"]
+    eventDate = timestamp[0:10]
+    todayDate = Today(eventDate)
+    if settings.todayOnly and eventDate != todayDate:
+        starName = event["StarSystem"]
+        _DISCARDS.debug("Event for %s discarded as not today: %s", starName, eventDate)
+        return ((), "filter_date")
+    return (destinations, None)
 
 def IsInterestingSystem(event):
     """Returns True if the FSDJump event (or equivalent subset of Location event)
         provided by Journal references a system we are interested in, else False.
     """
+    return len(_destinations(_SETTINGS, event)) > 0
+
+def _destinations(settings, event):
     # Extract the star name which is always provided
     starName = event["StarSystem"]
-    # Determine if the system must always be included in updates
-    if starName in _INCLUDE_SYSTEM_SET:
-        return True
-    # Extract the StarPos to confirm we're interested
+    # Systems do not move, so reuse any previous verdict for this system
+    verdicts = settings.verdicts
+    verdict = verdicts.get(starName)
+    if verdict is not None:
+        return verdict
+    # Systems that must always be included, followed by those of the locations
+    #  containing the StarPos
+    destinations = list(settings.includeSystems.get(starName, []))
     (starPosX, starPosY, starPosZ) = event["StarPos"]
-    for location in _LOCATIONS:
-        x = location['x']
-        y = location['y']
-        z = location['z']
-        d2 = location['d2']
-        starDist2 = pow(x-starPosX,2)+pow(y-starPosY,2)+pow(z-starPosZ,2)
-        if starDist2 <= d2:
-            return True
-    # Not included in any particular location selection, so not interested
-    return False
+    for location in settings.index.findAll(starPosX, starPosY, starPosZ):
+        if location['destination'] not in destinations:
+            destinations.append(location['destination'])
+    verdict = tuple(destinations)
+    # Remember the verdict (unless disabled), discarding the oldest if we have too many
+    if settings.systemCacheSize > 0:
+        if len(verdicts) >= settings.systemCacheSize:
+            verdicts.popitem(last=False)
+        verdicts[starName] = verdict
+    return verdict
 
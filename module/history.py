@@ -0,0 +1,293 @@
+"""Provides a bounded in-memory history of the influence of each faction in each
+    system, held in NumPy ring buffers, from which trends and the daily tick can
+    be queried, with snapshots saved to (and restored from) an .npz file.
+"""
+from config import Config
+from metrics import Increment, SetGauge, Describe
+from calendar import timegm
+from os import rename
+from os.path import isfile
+import atexit
+import threading
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None # the history is unavailable without NumPy
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("history")
+
+# Configuration for the history, where each series is one faction in one system
+_HISTORY_ENABLED = Config.getBoolean('history', 'enabled', False)
+_HISTORY_SERIES = Config.getInteger('history', 'series', 20000)
+_HISTORY_SAMPLES = Config.getInteger('history', 'samples', 64)
+_HISTORY_FILE = Config.getString('history', 'file', 'logs/history.npz')
+_HISTORY_SAVE_INTERVAL = Config.getInteger('history', 'save_interval', 300)
+
+Describe("gurgle_history_series", "Faction series held in the influence history.")
+Describe("gurgle_history_evictions_total", "Faction series evicted from the influence history to make room.")
+
+# Start of each day (in seconds since the epoch), to avoid parsing every timestamp
+_DAYS = {}
+
+def _epoch(timestamp):
+    """Returns the seconds since the epoch for the Journal timestamp."""
+    day = _DAYS.get(timestamp[0:10])
+    if day is None:
+        day = _DAYS[timestamp[0:10]] = timegm(time.strptime(timestamp[0:10], "%Y-%m-%d"))
+    return day + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+
+class InfluenceHistory(object):
+    """Ring buffers of the influence and state of each faction in each system.
+
+    Each sample records a distinct value, along with the first and last time it
+    was seen, so repeated reports of an unchanged system only extend the latest
+    sample. A change of influence therefore brackets the tick between the last
+    time the previous value was seen and the first time the new value was seen.
+    When all series are in use, the series seen least recently is evicted.
+    """
+    def __init__(self, series, samples):
+        self.series = max(series, 1)
+        self.samples = max(samples, 2)
+        shape = (self.series, self.samples)
+        self.first = numpy.zeros(shape, numpy.float64)
+        self.last = numpy.zeros(shape, numpy.float64)
+        self.influence = numpy.zeros(shape, numpy.float32)
+        self.state = numpy.zeros(shape, numpy.int16)
+        self.head = numpy.zeros(self.series, numpy.int32) # next sample written
+        self.count = numpy.zeros(self.series, numpy.int32)
+        self.seen = numpy.zeros(self.series, numpy.float64)
+        self.systemIds = numpy.zeros(self.series, numpy.int32)
+        # Row of each faction series, by system, and the (system, faction) of each row
+        self.systems = {}
+        self.keys = [None] * self.series
+        self.free = range(self.series - 1, -1, -1)
+        self.systemNos = {}
+        self.states = [""]
+        self.stateCodes = { "": 0 }
+        self.lock = threading.Lock()
+
+    def record(self, snapshot):
+        """Records the influence and state of the factions in the SystemSnapshot."""
+        seen = _epoch(snapshot.timestamp)
+        with self.lock:
+            for faction in snapshot.factions:
+                self._append(self._row(snapshot.starSystem, faction.name), seen, seen,
+                    faction.influence, self._code(faction.state))
+            SetGauge("gurgle_history_series", self.series - len(self.free))
+
+    def _code(self, state):
+        code = self.stateCodes.get(state)
+        if code is None:
+            code = self.stateCodes[state] = len(self.states)
+            self.states.append(state)
+        return code
+
+    def _row(self, system, faction):
+        """Returns the row holding the series, allocating (or evicting) one if new."""
+        factions = self.systems.get(system)
+        if factions is not None and faction in factions:
+            return factions[faction]
+        if len(self.free) == 0:
+            self._evict(int(numpy.argmin(self.seen)))
+        row = self.free.pop()
+        self.systems.setdefault(system, {})[faction] = row
+        self.keys[row] = (system, faction)
+        self.systemIds[row] = self.systemNos.setdefault(system, len(self.systemNos))
+        self.head[row] = self.count[row] = 0
+        return row
+
+    def _evict(self, row):
+        (system, faction) = self.keys[row]
+        factions = self.systems[system]
+        del factions[faction]
+        if len(factions) == 0:
+            del self.systems[system]
+        self.keys[row] = None
+        self.seen[row] = 0
+        self.free.append(row)
+        Increment("gurgle_history_evictions_total")
+
+    def _append(self, row, first, last, influence, code):
+        count = self.count[row]
+        if count > 0:
+            latest = self.head[row] - 1 # wraps to the end of the row when the head is 0
+            if first < self.first[row, latest]:
+                return # older than the latest value, so the series has moved on
+            if self.influence[row, latest] == numpy.float32(influence) and self.state[row, latest] == code:
+                self.last[row, latest] = max(last, self.last[row, latest])
+                self.seen[row] = max(last, self.seen[row])
+                return
+        sample = self.head[row]
+        self.first[row, sample] = first
+        self.last[row, sample] = last
+        self.influence[row, sample] = influence
+        self.state[row, sample] = code
+        self.head[row] = (sample + 1) % self.samples
+        self.count[row] = min(count + 1, self.samples)
+        self.seen[row] = max(last, self.seen[row])
+
+    def _ordered(self):
+        """Returns the sample indices of every row ordered from the oldest, along
+            with a mask of those holding samples.
+        """
+        offsets = numpy.arange(self.samples)
+        indices = (self.head - self.count)[:, None] + offsets[None, :]
+        return (indices % self.samples, offsets[None, :] < self.count[:, None])
+
+    def systemNames(self):
+        """Returns the names of the systems held, sorted."""
+        with self.lock:
+            return sorted(self.systems)
+
+    def trend(self, system):
+        """Returns the samples for each faction in the system, as a dictionary of
+            faction name to a list of (first seen, last seen, influence, state) tuples.
+        """
+        trends = {}
+        with self.lock:
+            for (faction, row) in self.systems.get(system, {}).iteritems():
+                count = self.count[row]
+                indices = (self.head[row] - count + numpy.arange(count)) % self.samples
+                trends[faction] = [(self.first[row, sample], self.last[row, sample],
+                    float(self.influence[row, sample]), self.states[self.state[row, sample]]) for sample in indices]
+        return trends
+
+    def latest(self):
+        """Returns the last time any system was seen, or None if empty."""
+        with self.lock:
+            return float(self.seen.max()) if len(self.free) < self.series else None
+
+    def changes(self, since=None, until=None):
+        """Returns arrays of the interval (from the last time the previous value was
+            seen, to the first time the new value was seen) of each change of
+            influence in each system, where the change was seen within the period.
+        """
+        with self.lock:
+            (indices, held) = self._ordered()
+            rows = numpy.arange(self.series)[:, None]
+            first = self.first[rows, indices]
+            last = self.last[rows, indices]
+            influence = self.influence[rows, indices]
+            systemIds = numpy.repeat(self.systemIds[:, None], self.samples - 1, axis=1)
+        # Pairs of consecutive samples where the influence changed (not just the state)
+        changed = held[:, 1:] & (influence[:, 1:] != influence[:, :-1])
+        if since is not None:
+            changed &= first[:, 1:] >= since
+        if until is not None:
+            changed &= first[:, 1:] <= until
+        (starts, ends, systemIds) = (last[:, :-1][changed], first[:, 1:][changed], systemIds[changed])
+        # Factions in a system are seen together, so count each change once per system
+        (_, unique) = numpy.unique((systemIds.astype(numpy.int64) << 32) + ends.astype(numpy.int64), return_index=True)
+        return (starts[unique], ends[unique])
+
+    def detectTick(self, since=None, until=None, minSystems=3):
+        """Returns the most likely tick within the period, as a tuple of the times
+            between which it occurred and the number of systems whose change spans
+            that period, or None if fewer than minSystems changes agree.
+
+        The tick is taken as the time spanned by the most change intervals, since
+        every system changing at a tick must have changed between the last time
+        it was seen before the tick and the first time it was seen after it.
+        """
+        (starts, ends) = self.changes(since, until)
+        if len(ends) == 0:
+            return None
+        candidates = numpy.unique(ends)
+        # Intervals spanning each candidate, i.e. those starting before and ending at or after it
+        spanning = (numpy.searchsorted(numpy.sort(starts), candidates, "left") -
+            numpy.searchsorted(numpy.sort(ends), candidates, "left"))
+        best = int(numpy.argmax(spanning))
+        if spanning[best] < minSystems:
+            return None
+        tick = candidates[best]
+        after = starts[(starts < tick) & (ends >= tick)].max()
+        return (float(after), float(tick), int(spanning[best]))
+
+    def save(self, fileName):
+        """Writes the history to the .npz file (replacing it once written)."""
+        with self.lock:
+            rows = numpy.array([row for row in range(self.series) if self.keys[row] is not None], numpy.int32)
+            arrays = { "first": self.first[rows], "last": self.last[rows], "influence": self.influence[rows],
+                "state": self.state[rows], "head": self.head[rows], "count": self.count[rows],
+                "systems": numpy.array([self.keys[row][0] for row in rows], numpy.unicode_),
+                "factions": numpy.array([self.keys[row][1] for row in rows], numpy.unicode_),
+                "states": numpy.array(self.states, numpy.unicode_) }
+        with open(fileName + ".tmp", "wb") as file:
+            numpy.savez_compressed(file, **arrays)
+        rename(fileName + ".tmp", fileName)
+        _LOGGER.debug("Saved history of %d faction series to %s", len(rows), fileName)
+
+    def load(self, fileName):
+        """Adds the history held in the .npz file, which may have been saved with
+            a different number of series or samples.
+        """
+        data = numpy.load(fileName)
+        (first, last, influence, state, head, count) = [data[name] for name in
+            ["first", "last", "influence", "state", "head", "count"]]
+        states = data["states"]
+        samples = first.shape[1] if len(first.shape) == 2 else 0
+        with self.lock:
+            for (stored, (system, faction)) in enumerate(zip(data["systems"], data["factions"])):
+                row = self._row(unicode(system), unicode(faction))
+                for offset in range(count[stored]):
+                    sample = (head[stored] - count[stored] + offset) % samples
+                    self._append(row, first[stored, sample], last[stored, sample],
+                        influence[stored, sample], self._code(unicode(states[state[stored, sample]])))
+            SetGauge("gurgle_history_series", self.series - len(self.free))
+        _LOGGER.info("Loaded history of %d faction series from %s", len(count), fileName)
+
+def LoadHistory(fileName=_HISTORY_FILE):
+    """Returns the history loaded from the .npz file (for querying)."""
+    history = InfluenceHistory(_HISTORY_SERIES, _HISTORY_SAMPLES)
+    history.load(fileName)
+    return history
+
+# History maintained from the updates posted, once started
+_HISTORY = None
+
+def StartHistory():
+    """Starts recording the history (restoring it from the configured file, and
+        saving it periodically and on exit), if enabled and NumPy is available.
+    """
+    global _HISTORY
+    if not _HISTORY_ENABLED or _HISTORY is not None:
+        return
+    if numpy is None:
+        _LOGGER.warning("History disabled as NumPy is not installed")
+        return
+    history = InfluenceHistory(_HISTORY_SERIES, _HISTORY_SAMPLES)
+    if isfile(_HISTORY_FILE):
+        try:
+            history.load(_HISTORY_FILE)
+        except Exception:
+            _LOGGER.exception("Unable to load history from %s", _HISTORY_FILE)
+    _HISTORY = history
+    atexit.register(SaveHistory)
+    if _HISTORY_SAVE_INTERVAL > 0:
+        thread = threading.Thread(target=_savePeriodically, name="history-save")
+        thread.daemon = True
+        thread.start()
+
+def RecordSnapshot(snapshot):
+    """Records the SystemSnapshot in the history, if started."""
+    if _HISTORY is not None:
+        try:
+            _HISTORY.record(snapshot)
+        except Exception:
+            _LOGGER.exception("Unable to record history for %s", snapshot.starSystem)
+
+def SaveHistory():
+    """Writes the history to the configured file, if started."""
+    if _HISTORY is not None:
+        try:
+            _HISTORY.save(_HISTORY_FILE)
+        except Exception:
+            _LOGGER.exception("Unable to save history to %s", _HISTORY_FILE)
+
+def _savePeriodically():
+    while True:
+        time.sleep(_HISTORY_SAVE_INTERVAL)
+        SaveHistory()
@@ -1,132 +1,136 @@
 from math import pow, sqrt
 from config import Config
-from filter import IsInteresting
+from filter import DestinationsOrReject
 from sheet import PostUpdate
+from message import CountStage
+from snapshot import FactionState, SystemSnapshot, Fingerprint, Intern
+from operator import attrgetter
 import re
 
 # Logger instance used by the functions in this module
 _LOGGER = Config.getLogger("influence")
+_DISCARDS = Config.getRateLimitedLogger("influence.discards")
 
-# Determine whether we are rounding the distance or location
-_ROUND_DISTANCE = Config.getInteger('events', 'distancedp', -1)
-_ROUND_LOCATION = Config.getInteger('events', 'locationdp', -1)
+class InfluenceSettings(object):
+    """Settings that determine the updates extracted from the events, replaced
+        as a whole when the configuration is reloaded.
+    """
+    def __init__(self):
+        # Determine whether we are rounding the distance or location
+        self.roundDistance = Config.getInteger('events', 'distancedp', -1)
+        self.roundLocation = Config.getInteger('events', 'locationdp', -1)
+        # Allow specific factions to be ignored
+        self.ignoreFactions = set()
+        ignoreFactions = Config.getString('events', 'ignore_factions')
+        if ignoreFactions is not None and len(ignoreFactions.strip()) > 0:
+            self.ignoreFactions.update([faction.strip() for faction in ignoreFactions.split(",")])
 
-# Allow specific factions to be ignored
-_IGNORE_FACTION_SET = set()
-_IGNORE_FACTIONS = Config.getString('events', 'ignore_factions')
-if _IGNORE_FACTIONS is not None and len(_IGNORE_FACTIONS.strip()) > 0:
-    _IGNORE_FACTION_SET.update([faction.strip() for faction in _IGNORE_FACTIONS.split(",")])
+_SETTINGS = InfluenceSettings()
 
-# Define the coordinates for the primary location used to define distance
-_LOCATION_X = Config.getFloat('location', 'x')
-_LOCATION_Y = Config.getFloat('location', 'y')
-_LOCATION_Z = Config.getFloat('location', 'z')
+def _reload():
+    settings = InfluenceSettings()
+    def commit():
+        global _SETTINGS
+        _SETTINGS = settings
+    return commit
+Config.onReload(_reload)
 
 # Provide regular expressions to remove extraneous text specifiers
 _MATCH_GOV = re.compile(r'\$government_(.*);', re.IGNORECASE)
-_MATCH_SEC = re.compile(r'\$system_security_(.*);', re.IGNORECASE)
-_MATCH_SEC2 = re.compile(r'\$GAlAXY_MAP_INFO_state_(.*);', re.IGNORECASE)
+_MATCH_SEC = re.compile(r'\$(?:system_security_|GAlAXY_MAP_INFO_state_)(.*);', re.IGNORECASE)
 _MATCH_ECO = re.compile(r'\$economy_(.*);', re.IGNORECASE)
+# The labels extracted from each text specifier, as only a handful are in use
+_LABELS = {}
+_MAX_LABELS = 1024
 
 
 def ConsumeFSDJump(event):
     """Consumes the FSDJump event (or equivalent subset of Location event)
         provided by Journal, extracting the factions and influence levels.
     """
+    snapshot = ExtractUpdate(event)
+    if snapshot is not None:
+        # Send the update
+        PostUpdate(snapshot)
+
+def ExtractUpdate(event):
+    """Extracts the update for the FSDJump event (or equivalent subset of Location
+        event), returning the SystemSnapshot, or None if the event is not of interest.
+    """
+    (snapshot, reject) = ExtractUpdateOrReject(event)
+    if reject is not None:
+        CountStage(reject)
+    return snapshot
+
+def ExtractUpdateOrReject(event):
+    """Extracts the update for the event (as for ExtractUpdate), returning a tuple
+        of the SystemSnapshot and the reason the event is rejected if there is
+        none (without counting it, as this may be within a worker process).
+    """
     # Only update information if we are interested in the update
-    if not IsInteresting(event):
-        return
+    (destinations, reject) = DestinationsOrReject(event)
+    if reject is not None:
+        return (None, reject)
+    settings = _SETTINGS
     # Extract the StarPos
     (starPosX, starPosY, starPosZ) = event["StarPos"]
-    starDist2 = pow(_LOCATION_X-starPosX,2)+pow(_LOCATION_Y-starPosY,2)+pow(_LOCATION_Z-starPosZ,2)
     # Extract the star name which is always provided
     starName = event["StarSystem"]
     # Extract the timestamp information
     timestamp = event["timestamp"]
-    eventDate = timestamp[0:10]
-    eventTime = timestamp[11:19]
 
-    # Nothing else below here guaranteed to be available
-    systemFaction = event.get("SystemFaction", "")
-    systemAllegiance = event.get("SystemAllegiance", "")
-    systemSecurity = event.get("SystemSecurity", "")
-    systemGovernment = event.get("SystemGovernment", "")
-    systemEconomy = event.get("SystemEconomy", "")
+    # Compute the distance from the location of each destination
+    routes = tuple([(destination, _distance(settings, destination, starPosX, starPosY, starPosZ))
+        for destination in destinations])
+    distance = routes[0][1]
+    if settings.roundLocation >= 0:
+        starPosX = round(starPosX, settings.roundLocation)
+        starPosY = round(starPosY, settings.roundLocation)
+        starPosZ = round(starPosZ, settings.roundLocation)
 
     # Grab the list of factions, if available
-    factionList = event.get("Factions", [])
+    factionList = [FactionState(faction) for faction in event.get("Factions") or []]
+    # Only want to update if we have factions to report on...
+    factions = [faction for faction in factionList if faction.name not in settings.ignoreFactions]
+    if len(factionList) == 0:
+        _DISCARDS.debug("Event for %s (%.1fly) discarded since no factions present.", starName, distance)
+        return (None, "filter_no_factions")
+    if len(factions) == 0:
+        _DISCARDS.debug("Event for %s (%.1fly) discarded since no interesting factions present.", starName, distance)
+        return (None, "filter_ignored_factions")
+    _LOGGER.debug("Processing update for %s (%.1fly) from %s", starName, distance, timestamp)
     # Sort by descending influence (just in case)
-    factionList = sorted(factionList, key=lambda faction: float(faction["Influence"]), reverse=True)
+    factions.sort(key=attrgetter("influence"), reverse=True)
+    snapshot = SystemSnapshot(timestamp, starName, (starPosX, starPosY, starPosZ), distance,
+        tuple(factions), Fingerprint(factionList))
+    snapshot.routes = routes
+    # Nothing else below here guaranteed to be available
+    snapshot.systemFaction = event.get("SystemFaction", "")
+    snapshot.allegiance = Intern(event.get("SystemAllegiance", ""))
+    snapshot.security = _label(_MATCH_SEC, event.get("SystemSecurity"))
+    snapshot.government = _label(_MATCH_GOV, event.get("SystemGovernment"))
+    snapshot.economy = _label(_MATCH_ECO, event.get("SystemEconomy"))
+    snapshot.population = event.get("Population", "")
+    return (snapshot, None)
 
+def _distance(settings, destination, starPosX, starPosY, starPosZ):
+    starDist2 = (pow(destination.x-starPosX,2)+pow(destination.y-starPosY,2)+
+        pow(destination.z-starPosZ,2))
     # Compute the distance as square root
     distance = sqrt(starDist2)
-    if _ROUND_DISTANCE >= 0:
-        distance = round(distance, _ROUND_DISTANCE)
-    if _ROUND_LOCATION >= 0:
-        starPosX = round(starPosX, _ROUND_LOCATION)
-        starPosY = round(starPosY, _ROUND_LOCATION)
-        starPosZ = round(starPosZ, _ROUND_LOCATION)
-
-    # Only want to update if we have factions to report on...
-    if len(factionList) == 0:
-        _LOGGER.debug("Event for %s (%.1fly) discarded since no factions present.", starName, distance)
-    elif set([x["Name"] for x in factionList]).issubset(_IGNORE_FACTION_SET):
-        _LOGGER.debug("Event for %s (%.1fly) discarded since no interesting factions present.", starName, distance)
-    else: # len(factionList) > 0
-        _LOGGER.debug("Processing update for %s (%.1fly) from %s", starName, distance, timestamp)
-        # Create the update
-        update = CreateUpdate(timestamp, starName, systemFaction, factionList)
-        update["EventDate"] = eventDate
-        update["EventTime"] = eventTime
-        # Add the other useful information
-        update["Distance"] = distance
-        update["LocationX"] = starPosX
-        update["LocationY"] = starPosY
-        update["LocationZ"] = starPosZ
-        update["Population"] = event.get("Population", "")
-        if len(systemAllegiance) > 0:
-            update["SystemAllegiance"] = systemAllegiance
-        if len(systemSecurity) > 0 and _MATCH_SEC.match(systemSecurity) is not None:
-            update["SystemSecurity"] = _MATCH_SEC.match(systemSecurity).group(1)
-        if len(systemSecurity) > 0 and _MATCH_SEC2.match(systemSecurity) is not None:
-            update["SystemSecurity"] = _MATCH_SEC2.match(systemSecurity).group(1)
-        if len(systemGovernment) > 0 and _MATCH_GOV.match(systemGovernment) is not None:
-            update["SystemGovernment"] = _MATCH_GOV.match(systemGovernment).group(1)
-        if len(systemEconomy) > 0 and _MATCH_ECO.match(systemEconomy) is not None:
-            update["SystemEconomy"] = _MATCH_ECO.match(systemEconomy).group(1)
-        # Send the update
-        PostUpdate(update, factionList)
+    if settings.roundDistance >= 0:
+        distance = round(distance, settings.roundDistance)
+    return distance
 
-def CreateUpdate(timestamp, starName, systemFaction, factionList):
-    """Formats the information for the upload to the Google Sheet."""
-    data = { "Timestamp": timestamp, "StarSystem": starName, "SystemFaction": systemFaction }
-    data["SystemAllegiance"] = ""
-    data["SystemSecurity"] = ""
-    data["SystemGovernment"] = ""
-    data["SystemEconomy"] = ""
-    factionNo = 1
-    for faction in factionList:
-        # Not interested in these factions
-        if faction["Name"] in _IGNORE_FACTION_SET:
-            continue
-        prefix = "Faction{:d}".format(factionNo)
-        data[prefix+"Name"] = faction["Name"]
-        data[prefix+"Influence"] = faction["Influence"]
-        data[prefix+"State"] = faction["FactionState"]
-        data[prefix+"Allegiance"] = faction["Allegiance"]
-        data[prefix+"Government"] = faction["Government"]
-        # Support for Pending/Recovering States
-        #  since sheet is expecting either all information or none for
-        #  each faction we always need to specify these, even if not present
-        states = []
-        if "PendingStates" in faction and faction["PendingStates"] is not None:
-            for pendingState in faction["PendingStates"]:
-                states.append(pendingState["State"])
-        data[prefix+"PendingState"] = ",".join(states)
-        states = []
-        if "RecoveringStates" in faction and faction["RecoveringStates"] is not None:
-            for recoveringState in faction["RecoveringStates"]:
-                states.append(recoveringState["State"])
-        data[prefix+"RecoveringState"] = ",".join(states)
-        factionNo = factionNo + 1
-    return data
+def _label(pattern, value):
+    """Returns the label within the text specifier, else an empty string."""
+    if not value:
+        return ""
+    key = (pattern, value)
+    label = _LABELS.get(key)
+    if label is None:
+        match = pattern.match(value)
+        label = Intern(match.group(1)) if match is not None else ""
+        if len(_LABELS) < _MAX_LABELS:
+            _LABELS[key] = label
+    return label
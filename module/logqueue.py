@@ -0,0 +1,149 @@
+"""Provides for logging asynchronously, so that formatting and writing the log does
+    not hold up the processing of events, and for rate limiting repetitive messages.
+
+The QueueHandler and QueueListener follow those of Python 3's logging.handlers,
+which are not available in Python 2.
+"""
+import logging
+import threading
+import time
+
+# Placed on the queue to stop the listener
+_SENTINEL = None
+
+
+class QueueHandler(logging.Handler):
+    """Places each record on the queue, for the QueueListener to handle.
+
+    Records are discarded if the queue is full, rather than waiting for it to be
+    drained, with a warning giving the number discarded once there is room.
+    Since the records are handled within the same process, the message is only
+    formatted by the QueueListener.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            if self.dropped > 0:
+                self.queue.put_nowait(logging.makeLogRecord({ "name": "logging", "levelno": logging.WARNING,
+                    "levelname": "WARNING", "msg": "Discarded %d log records while the queue was full",
+                    "args": (self.dropped,) }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except Exception:
+            self.dropped += 1 # the queue is full
+
+class QueueListener(object):
+    """Handles the records placed on the queue by the QueueHandler from a
+        background thread, passing each to the handlers whose level it meets.
+    """
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        """Starts the thread handling the records, if not already running."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="logging")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Handles the records already queued, then stops the thread."""
+        if self.thread is not None:
+            self.queue.put(_SENTINEL)
+            self.thread.join()
+            self.thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _SENTINEL:
+                break
+            try:
+                self.handle(record)
+            except Exception:
+                pass # handlers report their own errors, so only the thread is protected
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most the given number of records with the same message (before
+        the arguments are applied) in each window, reporting the number suppressed
+        once the window ends, from a background thread started on the first
+        record suppressed.
+    """
+    def __init__(self, rate, window):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.window = window
+        self.windows = {} # message -> [start of window, records passed, records suppressed, last record]
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        now = record.created
+        with self.lock:
+            entry = self.windows.get(record.msg)
+            if entry is None:
+                self.windows[record.msg] = [now, 1, 0, record]
+                return True
+            if now - entry[0] < self.window:
+                if entry[1] < self.rate:
+                    entry[1] += 1
+                    return True
+                entry[2] += 1
+                entry[3] = record
+                self._start()
+                return False
+            (since, suppressed) = (entry[0], entry[2])
+            entry[:] = [now, 1, 0, record]
+        if suppressed > 0:
+            self._summarise(record, suppressed, since)
+        return True
+
+    def flush(self, now=None):
+        """Reports the number of records suppressed in each window that has ended,
+            forgetting those windows.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            ended = [(message, entry) for (message, entry) in self.windows.iteritems()
+                if now - entry[0] >= self.window]
+            for (message, entry) in ended:
+                del self.windows[message]
+        for (message, entry) in ended:
+            if entry[2] > 0:
+                self._summarise(entry[3], entry[2], entry[0])
+
+    def _start(self):
+        """Starts the thread flushing the windows, if not running (as in a forked process)."""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="logging-rate-limit")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(1.0)
+            try:
+                self.flush()
+            except Exception:
+                pass # handlers report their own errors, so only the thread is protected
+
+    def _summarise(self, record, suppressed, since):
+        summary = logging.makeLogRecord({ "name": record.name, "levelno": record.levelno,
+            "levelname": record.levelname, "msg": "Suppressed %d similar messages since %s: %s",
+            "args": (suppressed, time.strftime("%H:%M:%S", time.localtime(since)), record.msg) })
+        # Handled directly, since the summary must not be subject to the filters of the logger
+        logging.getLogger(record.name).callHandlers(summary)
@@ -0,0 +1,97 @@
+"""Provides for decoding EDDN messages and Journal lines into the events of interest."""
+from metrics import Increment, Describe
+import hashlib
+import re
+try:
+    import ujson as json # faster decoding of the full message, when installed
+except ImportError:
+    import json
+
+# Only interested in the Journal Schema ($schemaRef)
+_SCHEMA_REFS = [ "http://schemas.elite-markets.net/eddn/journal/1", "https://eddn.edcd.io/schemas/journal/1" ]
+# Only interested in FSDJump or Location events
+_EVENTS = [ "FSDJump", "Location" ]
+
+# Byte sequences that must be present in the raw message for it to be of interest,
+#  allowing most of the relay traffic to be rejected without decoding the JSON.
+#  These only need to avoid false negatives, as the decoded message is checked again.
+_ENVELOPE_MARKER = "\"$schemaRef\""
+_SCHEMA_MARKERS = [ "journal/1\"", "journal\\/1\"" ]
+_EVENT_MARKERS = [ "\"%s\"" % event for event in _EVENTS ]
+
+# Header fields identifying a message, which are the same whichever relay it arrives from
+_MATCH_UPLOADER = re.compile(r'"uploaderID"\s*:\s*"([^"]*)"')
+_MATCH_GATEWAY_TIMESTAMP = re.compile(r'"gatewayTimestamp"\s*:\s*"([^"]*)"')
+
+# Names of the stages at which a message is rejected, or "consumed" if not
+STAGES = [ "scan_schema", "scan_event", "parse_schema", "parse_event", "consumed" ]
+# Names of the reasons a consumed event is rejected by the filter (when extracting the update)
+REJECTS = [ "filter_distance", "filter_date", "filter_no_factions", "filter_ignored_factions" ]
+# Metric (and labels) counted for each stage, or failure to decode ("errors")
+_STAGE_METRICS = {
+    "scan_schema": ("gurgle_filter_rejects_total", { "reason": "schema", "stage": "scan" }),
+    "scan_event": ("gurgle_filter_rejects_total", { "reason": "event", "stage": "scan" }),
+    "parse_schema": ("gurgle_filter_rejects_total", { "reason": "schema", "stage": "parse" }),
+    "parse_event": ("gurgle_filter_rejects_total", { "reason": "event", "stage": "parse" }),
+    "filter_distance": ("gurgle_filter_rejects_total", { "reason": "distance", "stage": "filter" }),
+    "filter_date": ("gurgle_filter_rejects_total", { "reason": "date", "stage": "filter" }),
+    "filter_no_factions": ("gurgle_filter_rejects_total", { "reason": "no_factions", "stage": "filter" }),
+    "filter_ignored_factions": ("gurgle_filter_rejects_total", { "reason": "ignored_factions", "stage": "filter" }),
+    "consumed": ("gurgle_messages_consumed_total", None),
+    "errors": ("gurgle_parse_failures_total", None) }
+Describe("gurgle_filter_rejects_total", "Events rejected, by reason and the stage rejecting them.")
+Describe("gurgle_parse_failures_total", "Messages that could not be decoded or processed.")
+
+def _containsAny(message, markers):
+    for marker in markers:
+        if marker in message:
+            return True
+    return False
+
+def CountStage(stage, count=1):
+    """Counts messages reaching the stage (as returned by DecodeMessage/DecodeLine),
+        or rejected for the reason (as returned by ExtractUpdateOrReject).
+    """
+    (name, labels) = _STAGE_METRICS[stage]
+    Increment(name, count, labels)
+
+def DecodeMessage(message):
+    """Decodes the specified EDDN message, returning a tuple of the stage reached
+        and the journal content (None unless "consumed").
+    """
+    # Cheap byte scans of the payload to reject most messages without decoding
+    if not _containsAny(message, _SCHEMA_MARKERS):
+        return ("scan_schema", None)
+    if not _containsAny(message, _EVENT_MARKERS):
+        return ("scan_event", None)
+    jsonmsg = json.loads(message)
+    if jsonmsg["$schemaRef"] not in _SCHEMA_REFS:
+        return ("parse_schema", None)
+    content = jsonmsg["message"]
+    if content["event"] not in _EVENTS:
+        return ("parse_event", None)
+    return ("consumed", content)
+
+def MessageKey(message):
+    """Returns the key identifying the EDDN message, from the uploader and gateway
+        timestamp in the header (found without decoding), else a hash of the message.
+    """
+    uploader = _MATCH_UPLOADER.search(message)
+    gatewayTimestamp = _MATCH_GATEWAY_TIMESTAMP.search(message)
+    if uploader is not None and gatewayTimestamp is not None:
+        return (uploader.group(1), gatewayTimestamp.group(1))
+    return hashlib.sha1(message).digest()
+
+def DecodeLine(line):
+    """Decodes the specified line, which is either a bare Journal event or an EDDN
+        message, returning a tuple of the stage reached and the journal content
+        (None unless "consumed").
+    """
+    if _ENVELOPE_MARKER in line:
+        return DecodeMessage(line)
+    if not _containsAny(line, _EVENT_MARKERS):
+        return ("scan_event", None)
+    content = json.loads(line)
+    if content["event"] not in _EVENTS:
+        return ("parse_event", None)
+    return ("consumed", content)
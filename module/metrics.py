@@ -0,0 +1,191 @@
+"""Provides for runtime metrics (counters, gauges and latency histograms), exposed
+    in the Prometheus text format and as a periodic summary log line, along with
+    on-demand profiling of the main loop.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from config import Config
+from os.path import join
+import cProfile
+import signal
+import threading
+import time
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("metrics")
+
+# Configuration for the exposure of the metrics
+_METRICS_ADDRESS = Config.getString('metrics', 'address', '127.0.0.1')
+_METRICS_PORT = Config.getInteger('metrics', 'port', 0)
+_METRICS_SUMMARY_INTERVAL = Config.getInteger('metrics', 'summary_interval', 300)
+_METRICS_PROFILE_SECONDS = Config.getInteger('metrics', 'profile_seconds', 30)
+_LOG_DIRECTORY = Config.getString('logging', 'directory', '.')
+
+# Default histogram buckets (in seconds) suited to network latency
+_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Values of each metric, keyed by name and then by a tuple of sorted label pairs
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_GAUGES = {}
+_HISTOGRAMS = {}
+_HELP = {}
+
+def _key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def Describe(name, text):
+    """Records the help text shown for the metric."""
+    _HELP[name] = text
+
+def Increment(name, amount=1, labels=None):
+    """Increments the counter with the specified labels."""
+    key = _key(labels)
+    with _LOCK:
+        values = _COUNTERS.setdefault(name, {})
+        values[key] = values.get(key, 0) + amount
+
+def SetGauge(name, value, labels=None):
+    """Sets the gauge with the specified labels."""
+    key = _key(labels)
+    with _LOCK:
+        _GAUGES.setdefault(name, {})[key] = value
+
+def Observe(name, value, labels=None):
+    """Records the value (typically a duration in seconds) in the histogram."""
+    key = _key(labels)
+    with _LOCK:
+        values = _HISTOGRAMS.setdefault(name, {})
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = [[0] * len(_BUCKETS), 0.0, 0]
+        for bucketNo, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                histogram[0][bucketNo] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def GetCounter(name, labels=None):
+    """Returns the current value of the counter with the specified labels."""
+    with _LOCK:
+        return _COUNTERS.get(name, {}).get(_key(labels), 0)
+
+def _format(name, key, extra=None):
+    labels = list(key) + (extra or [])
+    if len(labels) == 0:
+        return name
+    return "%s{%s}" % (name, ",".join(['%s="%s"' % (label, value) for (label, value) in labels]))
+
+def Render():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _LOCK:
+        for (metrics, metricType) in [(_COUNTERS, "counter"), (_GAUGES, "gauge")]:
+            for name in sorted(metrics):
+                if name in _HELP:
+                    lines.append("# HELP %s %s" % (name, _HELP[name]))
+                lines.append("# TYPE %s %s" % (name, metricType))
+                for key in sorted(metrics[name]):
+                    lines.append("%s %s" % (_format(name, key), repr(metrics[name][key])))
+        for name in sorted(_HISTOGRAMS):
+            if name in _HELP:
+                lines.append("# HELP %s %s" % (name, _HELP[name]))
+            lines.append("# TYPE %s histogram" % name)
+            for key in sorted(_HISTOGRAMS[name]):
+                (buckets, total, count) = _HISTOGRAMS[name][key]
+                for bucketNo, bound in enumerate(_BUCKETS):
+                    lines.append("%s %d" % (_format(name+"_bucket", key, [("le", repr(bound))]), buckets[bucketNo]))
+                lines.append("%s %d" % (_format(name+"_bucket", key, [("le", "+Inf")]), count))
+                lines.append("%s %s" % (_format(name+"_sum", key), repr(total)))
+                lines.append("%s %d" % (_format(name+"_count", key), count))
+    return "\n".join(lines) + "\n"
+
+def Summary():
+    """Returns a single line summarising the counters, gauges and mean latencies."""
+    values = []
+    with _LOCK:
+        for metrics in [_COUNTERS, _GAUGES]:
+            for name in sorted(metrics):
+                for key in sorted(metrics[name]):
+                    values.append("%s=%s" % (_format(name, key), metrics[name][key]))
+        for name in sorted(_HISTOGRAMS):
+            for key in sorted(_HISTOGRAMS[name]):
+                (_, total, count) = _HISTOGRAMS[name][key]
+                values.append("%s=%.3fs/%d" % (_format(name, key), total / max(count, 1), count))
+    return " ".join(values)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics on /metrics."""
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = Render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # avoid logging every scrape
+
+def _logPeriodically():
+    while True:
+        time.sleep(_METRICS_SUMMARY_INTERVAL)
+        _LOGGER.info("Metrics: %s", Summary())
+
+def StartMetrics():
+    """Starts the metrics endpoint and periodic summary, where configured."""
+    if _METRICS_PORT > 0:
+        server = HTTPServer((_METRICS_ADDRESS, _METRICS_PORT), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+        thread.daemon = True
+        thread.start()
+        _LOGGER.info("Serving metrics on http://%s:%d/metrics", _METRICS_ADDRESS, _METRICS_PORT)
+    if _METRICS_SUMMARY_INTERVAL > 0:
+        thread = threading.Thread(target=_logPeriodically, name="metrics-summary")
+        thread.daemon = True
+        thread.start()
+
+class Profiler(object):
+    """Captures a cProfile of the calling thread for a period after SIGUSR1.
+
+    The profiler only applies to the thread that enables it, so the signal merely
+    requests the capture, which the main loop starts and stops through poll().
+    """
+    def __init__(self, seconds=_METRICS_PROFILE_SECONDS, directory=_LOG_DIRECTORY):
+        self.seconds = seconds
+        self.directory = directory
+        self.requested = False
+        self.profile = None
+        self.stopAt = 0
+
+    def install(self):
+        """Requests a capture on receipt of SIGUSR1 (only possible from the main thread)."""
+        try:
+            signal.signal(signal.SIGUSR1, self._request)
+        except ValueError:
+            _LOGGER.debug("Profiling on SIGUSR1 unavailable outside of the main thread")
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+    def timeout(self, timeout):
+        """Returns the poll timeout (ms) to use, limited while a profile is being captured."""
+        return min(timeout, 1000) if self.profile is not None else timeout
+
+    def poll(self):
+        """Starts or stops the requested capture, called regularly by the main loop."""
+        if self.profile is not None:
+            if time.time() >= self.stopAt:
+                self.profile.disable()
+                fileName = join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+                self.profile.dump_stats(fileName)
+                self.profile = None
+                _LOGGER.info("Profile written to %s", fileName)
+        elif self.requested:
+            self.requested = False
+            self.stopAt = time.time() + self.seconds
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            _LOGGER.info("Profiling for %d seconds", self.seconds)
@@ -0,0 +1,334 @@
+"""Provides a write-ahead outbox of the updates sent to the Google Sheets, held in
+    append-only segment files, so that an update which cannot be sent (as the
+    sheet is down or over quota) is sent once the sheet recovers, even across
+    restarts, rather than being lost.
+"""
+from config import Config
+from metrics import Increment, SetGauge, Describe
+from os import listdir, makedirs, remove, fsync
+from os.path import isdir, join, getsize
+import atexit
+import json
+import re
+import threading
+import time
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("outbox")
+
+# Configuration for the outbox, where segments are replaced once they reach segment_size bytes
+_OUTBOX_ENABLED = Config.getBoolean('outbox', 'enabled', False)
+_OUTBOX_DIRECTORY = Config.getString('outbox', 'directory', 'logs/outbox')
+_OUTBOX_SEGMENT_SIZE = Config.getInteger('outbox', 'segment_size', 1048576)
+_OUTBOX_REPLAY_INTERVAL = Config.getInteger('outbox', 'replay_interval', 60)
+_OUTBOX_SYNC = Config.getBoolean('outbox', 'sync', False)
+
+Describe("gurgle_outbox_backlog", "Updates in the outbox not yet acknowledged by the sheet.")
+Describe("gurgle_outbox_oldest_seconds", "Age of the oldest update in the outbox not yet acknowledged.")
+Describe("gurgle_outbox_segments", "Segment files held by the outbox.")
+Describe("gurgle_outbox_replayed_total", "Updates resent from the outbox after failing (or on startup).")
+
+# Names of the segment files, numbered in the order written
+_SEGMENT_FORMAT = "%08d.log"
+_MATCH_SEGMENT = re.compile(r"^(\d{8})\.log$")
+
+
+class OutboxEntry(object):
+    """Update held by the outbox, in place of the SystemSnapshot it was written
+        from when resent after a restart.
+    """
+    __slots__ = ("timestamp", "eventDate", "starSystem", "distance", "fingerprint", "sheet", "update")
+
+    def __init__(self, record):
+        self.update = record["update"]
+        self.timestamp = self.update["Timestamp"]
+        self.eventDate = self.update["EventDate"]
+        self.starSystem = self.update["StarSystem"]
+        self.distance = self.update["Distance"]
+        self.fingerprint = record["fingerprint"]
+        self.sheet = record.get("sheet")
+
+    def toUpdate(self):
+        return self.update
+
+class _Pending(object):
+    """Location and state of an update not yet acknowledged."""
+    __slots__ = ("id", "fingerprint", "segment", "offset", "written", "inFlight")
+
+    def __init__(self, entryId, fingerprint, segment, offset, written, inFlight):
+        self.id = entryId
+        self.fingerprint = fingerprint
+        self.segment = segment
+        self.offset = offset
+        self.written = written
+        self.inFlight = inFlight
+
+
+class Outbox(object):
+    """Append-only log of the updates to be sent, and their acknowledgements.
+
+    Each update is written before it is sent, and acknowledged once the sheet
+    has accepted it (or it is no longer needed), with only the latest update
+    for each system (and date) on each sheet being kept, as it supersedes any
+    earlier update.
+    Only the location of each pending update is held in memory, the update
+    itself being read back from the segment when resent. Segments holding no
+    pending updates are removed, while those holding few are compacted by
+    copying their pending updates to the current segment.
+    """
+    def __init__(self, directory, segmentSize, sync):
+        self.directory = directory
+        self.segmentSize = max(segmentSize, 1024)
+        self.sync = sync
+        self.pending = {} # (sheet, date, system) -> _Pending
+        self.written = {} # segment -> updates written to it
+        self.nextId = 1
+        self.current = None
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+        # Key of the update being resent, notifying those waiting to supersede it once handed over
+        self.resending = None
+        self.resent = threading.Condition(self.lock)
+
+    def _path(self, segment):
+        return join(self.directory, _SEGMENT_FORMAT % segment)
+
+    def open(self):
+        """Reads the pending updates from the existing segments, starting a new segment."""
+        if not isdir(self.directory):
+            makedirs(self.directory)
+        segments = sorted([int(match.group(1)) for match in
+            [_MATCH_SEGMENT.match(name) for name in listdir(self.directory)] if match])
+        keys = {}
+        with self.lock:
+            for segment in segments:
+                self._read(segment, keys)
+            self._roll(segments[-1] + 1 if len(segments) > 0 else 1)
+            self._compact()
+            self._gauge()
+        if len(self.pending) > 0:
+            _LOGGER.info("Outbox holds %d updates not yet sent", len(self.pending))
+
+    def _read(self, segment, keys):
+        """Reads the updates and acknowledgements in the segment, where keys holds
+            the sheet, date and system of each update read so far, by id.
+        """
+        self.written[segment] = 0
+        with open(self._path(segment), "rb") as file:
+            offset = 0
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the end of the last segment written is expected to be incomplete
+                    _LOGGER.warning("Ignoring incomplete record in outbox segment %d at %d", segment, offset)
+                    offset += len(line)
+                    continue
+                if "ack" in record:
+                    key = keys.pop(record["ack"], None)
+                    entry = self.pending.get(key)
+                    if entry is not None and entry.id == record["ack"]:
+                        del self.pending[key]
+                else:
+                    key = keys[record["id"]] = _key(record)
+                    entry = self.pending.get(key)
+                    if entry is None or entry.id <= record["id"]:
+                        self.pending[key] = _Pending(record["id"], record["fingerprint"], segment, offset,
+                            record["written"], False)
+                    self.written[segment] += 1
+                    self.nextId = max(self.nextId, record["id"] + 1)
+                offset += len(line)
+
+    def _roll(self, segment):
+        """Starts writing to the new segment."""
+        if self.file is not None:
+            self.file.close()
+        self.current = segment
+        self.file = open(self._path(segment), "ab")
+        self.size = getsize(self._path(segment))
+        self.written.setdefault(segment, 0)
+
+    def _append(self, record):
+        """Writes the record to the current segment, returning its offset."""
+        offset = self.size
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self.file.write(line)
+        self.file.flush()
+        if self.sync:
+            fsync(self.file.fileno())
+        self.size += len(line)
+        return offset
+
+    def _compact(self):
+        """Removes the segments holding no pending updates, and moves the pending
+            updates out of those where they are at most a quarter of those written.
+
+        Segments are only removed from the oldest, as the acknowledgement of an
+        update is always written to the same (or a later) segment as the update.
+        """
+        live = {}
+        for entry in self.pending.itervalues():
+            live.setdefault(entry.segment, []).append(entry)
+        for segment in sorted(self.written):
+            if segment == self.current:
+                continue
+            entries = live.get(segment, [])
+            if len(entries) * 4 > self.written[segment]:
+                break
+            for entry in sorted(entries, key=lambda entry: entry.id):
+                record = self._load(entry)
+                entry.offset = self._append(record)
+                entry.segment = self.current
+                self.written[self.current] += 1
+            remove(self._path(segment))
+            del self.written[segment]
+            _LOGGER.debug("Compacted outbox segment %d (moved %d updates)", segment, len(entries))
+
+    def _load(self, entry):
+        with open(self._path(entry.segment), "rb") as file:
+            file.seek(entry.offset)
+            return json.loads(file.readline())
+
+    def _gauge(self):
+        SetGauge("gurgle_outbox_backlog", len(self.pending))
+        SetGauge("gurgle_outbox_segments", len(self.written))
+
+    def add(self, snapshot):
+        """Writes the update for the snapshot (which is being sent) to the outbox,
+            superseding any pending update for the same system (once handed over
+            to be resent, if being resent, so the newer update is sent after it).
+        """
+        key = (snapshot.sheet, snapshot.eventDate, snapshot.starSystem)
+        with self.lock:
+            while self.resending == key:
+                self.resent.wait()
+            record = { "id": self.nextId, "written": time.time(), "fingerprint": snapshot.fingerprint,
+                "sheet": snapshot.sheet, "update": snapshot.toUpdate() }
+            self.nextId += 1
+            offset = self._append(record)
+            self.pending[key] = _Pending(record["id"],
+                snapshot.fingerprint, self.current, offset, record["written"], True)
+            self.written[self.current] += 1
+            if self.size >= self.segmentSize:
+                self._roll(self.current + 1)
+                self._compact()
+            self._gauge()
+
+    def _entry(self, snapshot):
+        """Returns the pending update for the snapshot, unless since superseded."""
+        entry = self.pending.get((snapshot.sheet, snapshot.eventDate, snapshot.starSystem))
+        return entry if entry is not None and entry.fingerprint == snapshot.fingerprint else None
+
+    def acknowledge(self, snapshot):
+        """Records that the update for the snapshot no longer needs to be sent."""
+        with self.lock:
+            entry = self._entry(snapshot)
+            if entry is not None:
+                self._append({ "ack": entry.id })
+                del self.pending[(snapshot.sheet, snapshot.eventDate, snapshot.starSystem)]
+                self._gauge()
+
+    def release(self, snapshot):
+        """Records that the update for the snapshot failed, to be resent later."""
+        with self.lock:
+            entry = self._entry(snapshot)
+            if entry is not None:
+                entry.inFlight = False
+
+    def oldest(self):
+        """Returns when the oldest pending update was written, or None if empty."""
+        with self.lock:
+            return min([entry.written for entry in self.pending.itervalues()]) if len(self.pending) > 0 else None
+
+    def replay(self, resend):
+        """Resends the pending updates that are not in flight, oldest first, other
+            than to a sheet once resend refuses one (returning False while that
+            sheet is unavailable).
+        """
+        with self.lock:
+            waiting = sorted([(entry.id, key) for (key, entry) in self.pending.iteritems() if not entry.inFlight])
+        replayed = 0
+        refused = set()
+        for (entryId, key) in waiting:
+            if key[0] in refused:
+                continue
+            with self.lock:
+                entry = self.pending.get(key)
+                if entry is None or entry.id != entryId or entry.inFlight:
+                    continue # acknowledged or superseded since
+                snapshot = OutboxEntry(self._load(entry))
+                entry.inFlight = True
+                self.resending = key
+            try:
+                accepted = resend(snapshot)
+            finally:
+                with self.lock:
+                    self.resending = None
+                    self.resent.notify_all()
+            if not accepted:
+                self.release(snapshot)
+                refused.add(key[0])
+                continue
+            replayed += 1
+            Increment("gurgle_outbox_replayed_total")
+        if replayed > 0:
+            _LOGGER.info("Resent %d updates from the outbox", replayed)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def _key(record):
+    return (record.get("sheet"), record["update"]["EventDate"], record["update"]["StarSystem"])
+
+# Outbox of the updates sent to the sheet, once started
+_OUTBOX = None
+
+def StartOutbox(resend):
+    """Starts writing the updates sent to the outbox, if enabled, resending any
+        pending updates (from a background thread, so as not to hold up receiving
+        events, with any superseded since not resent) and then periodically those
+        that fail, with the function provided, which returns False if the update
+        cannot yet be sent.
+    """
+    global _OUTBOX
+    if not _OUTBOX_ENABLED or _OUTBOX is not None:
+        return
+    outbox = Outbox(_OUTBOX_DIRECTORY, _OUTBOX_SEGMENT_SIZE, _OUTBOX_SYNC)
+    outbox.open()
+    _OUTBOX = outbox
+    atexit.register(outbox.close)
+    thread = threading.Thread(target=_replayPeriodically, args=(outbox, resend), name="outbox")
+    thread.daemon = True
+    thread.start()
+
+def WriteAhead(snapshot):
+    """Writes the SystemSnapshot to the outbox before it is sent, if started."""
+    if _OUTBOX is not None:
+        _OUTBOX.add(snapshot)
+
+def Acknowledge(snapshot):
+    """Removes the snapshot from the outbox, once sent (or no longer needed)."""
+    if _OUTBOX is not None:
+        _OUTBOX.acknowledge(snapshot)
+
+def Release(snapshot):
+    """Leaves the snapshot in the outbox to be resent, once it has failed."""
+    if _OUTBOX is not None:
+        _OUTBOX.release(snapshot)
+
+def _replayPeriodically(outbox, resend):
+    nextReplay = time.time()
+    while True:
+        if time.time() >= nextReplay:
+            nextReplay = time.time() + _OUTBOX_REPLAY_INTERVAL
+            try:
+                outbox.replay(resend)
+            except Exception:
+                _LOGGER.exception("Unable to resend updates from the outbox")
+        oldest = outbox.oldest()
+        SetGauge("gurgle_outbox_oldest_seconds", time.time() - oldest if oldest is not None else 0)
+        time.sleep(1.0)
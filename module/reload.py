@@ -0,0 +1,76 @@
+"""Provides for reloading the configuration without restarting, on SIGHUP or when
+    the configuration files are modified.
+"""
+from config import Config
+from metrics import Increment, Describe
+import signal
+import threading
+import time
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("reload")
+
+# Seconds between checking for modified configuration files (0 only reloads on SIGHUP)
+_RELOAD_WATCH_INTERVAL = Config.getInteger('reload', 'watch_interval', 5)
+
+Describe("gurgle_config_reloads_total", "Attempts at reloading the configuration, by result.")
+
+
+class Reloader(object):
+    """Reloads the configuration from a background thread, so that the state
+        of each module is rebuilt away from the processing of events.
+
+    Only the settings that are reloadable (the [location] and [events] sections)
+    take effect, the remaining settings requiring a restart.
+    """
+    def __init__(self, watchInterval):
+        self.watchInterval = watchInterval
+        self.requested = False
+        self.thread = None
+
+    def install(self):
+        """Requests a reload on receipt of SIGHUP (only possible from the main thread)."""
+        try:
+            signal.signal(signal.SIGHUP, self._request)
+        except ValueError:
+            _LOGGER.debug("Reloading on SIGHUP unavailable outside of the main thread")
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+    def start(self):
+        """Starts the thread performing the reloads, if not already running."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="reload")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        nextCheck = time.time() + self.watchInterval
+        while True:
+            time.sleep(1.0)
+            if self.watchInterval > 0 and time.time() >= nextCheck:
+                nextCheck = time.time() + self.watchInterval
+                if Config.hasChanged():
+                    _LOGGER.info("Configuration files modified")
+                    self.requested = True
+            if self.requested:
+                self.requested = False
+                self.reload()
+
+    def reload(self):
+        """Reloads the configuration, keeping the existing configuration on failure."""
+        try:
+            Config.reload()
+            Increment("gurgle_config_reloads_total", labels={ "result": "success" })
+            _LOGGER.info("Configuration reloaded")
+        except Exception:
+            Increment("gurgle_config_reloads_total", labels={ "result": "failure" })
+            _LOGGER.exception("Unable to reload configuration, continuing with the existing configuration")
+
+def StartReloading():
+    """Reloads the configuration on SIGHUP, or when the files are modified."""
+    reloader = Reloader(_RELOAD_WATCH_INTERVAL)
+    reloader.install()
+    reloader.start()
+    return reloader
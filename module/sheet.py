@@ -1,7 +1,21 @@
-from urllib2 import urlopen
 from urllib import urlencode
+from urlparse import urljoin, urlsplit
+from Queue import Queue, Full, Empty
+from collections import OrderedDict
 from config import Config
-from cache import IsNotInCache, CacheUpdate
+from cache import IsNotInCache, CacheUpdate, SheetCache
+from sink import SHEET_ENABLED, WriteUpdate, FlushSinks
+from metrics import Increment, Observe, GetCounter, Describe
+from coalesce import Coalescer
+from history import RecordSnapshot
+from filter import FindDestination
+from outbox import WriteAhead, Acknowledge, Release
+import errno
+import heapq
+import httplib
+import random
+import socket
+import threading
 import json
 import time
 
@@ -9,61 +23,645 @@ import time
 _LOGGER = Config.getLogger("sheet")
 
 # Configuration for the Google Sheet interaction
-__SHEET_URL = Config.getRequiredString('sheet', 'url')
+__SHEET_URL = Config.getRequiredString('sheet', 'url') if SHEET_ENABLED else None
 __SHEET_API_KEY = Config.getCrypt('sheet', 'apikey')
 __SHEET_RETRIES = Config.getInteger('sheet', 'retries', 3)
 __SHEET_RETRY_WAIT = Config.getInteger('sheet', 'retry_wait', 3)
+__SHEET_RETRY_MAX_WAIT = Config.getInteger('sheet', 'retry_max_wait', 300)
 __SHEET_TIMEOUT = Config.getInteger('sheet', 'timeout', 10)
 __SHEET_RESPONSE_BUFFER = Config.getInteger('sheet', 'buffer', 1024)
+# Configuration for the circuit breaker that pauses sending while the sheet is failing
+__SHEET_BREAKER_FAILURES = Config.getInteger('sheet', 'breaker_failures', 5)
+__SHEET_BREAKER_COOLDOWN = Config.getInteger('sheet', 'breaker_cooldown', 60)
+# Configuration for the background sender pool (0 workers sends inline)
+__SHEET_WORKERS = Config.getInteger('sheet', 'workers', 1)
+__SHEET_QUEUE_SIZE = Config.getInteger('sheet', 'queue_size', 1000)
+__SHEET_QUEUE_FULL = Config.getString('sheet', 'queue_full', 'block')
+# Maximum updates held back while the queue is full, by the hold-latest policy
+__SHEET_HOLD_SIZE = Config.getInteger('sheet', 'hold_size', 10000)
+# Maximum updates sent in a single POST by each sender (requires the batch support in Code.gs)
+__SHEET_BATCH_SIZE = Config.getInteger('sheet', 'batch_size', 1)
+# Configuration for holding updates to collapse bursts for a system (0 disables)
+__COALESCE_WINDOW = Config.getInteger('coalesce', 'window', 0)
+__COALESCE_MAX_DELAY = Config.getInteger('coalesce', 'max_delay', 300)
 
+# Outcomes counted for each update posted
+_OUTCOMES = [ "sent", "failed", "cached", "discarded", "written" ]
+Describe("gurgle_updates_total", "Updates posted, by outcome.")
+Describe("gurgle_sheet_send_seconds", "Latency of each POST to the Google Sheet.")
+Describe("gurgle_sheet_connections_total", "Connections (TCP/TLS handshakes) opened, by host.")
 
-def PostUpdate(update, factionList):
-    """Responsible for sending the specified update to the Google Sheet."""
-    starName = update["StarSystem"]
-    eventDate = update["EventDate"]
-    distance = update["Distance"]
-    # Send the update, if Cache says we need to
-    if IsNotInCache(eventDate, starName, factionList):
-        if SendUpdate(update):
-            _LOGGER.info("Processed (sent) update for %s (%.1fly)", starName, distance)
-            # Update the Cache Entry (after send so we have definitely sent)
-            CacheUpdate(eventDate, starName, factionList)
+# Results of a single attempt to send an update
+_RESULT_SUCCESS = "success" # the sheet accepted the update
+_RESULT_RETRY = "retry" # infrastructure or sheet error, worth trying again later
+_RESULT_REJECTED = "rejected" # the sheet refused the update (i.e. invalid token)
+
+# Policies supported when the send queue is full
+_POLICY_BLOCK = "block"
+_POLICY_DROP_OLDEST = "drop-oldest"
+_POLICY_HOLD_LATEST = "hold-latest"
+
+# Policy applied in place of that configured, once set
+_queueFullPolicy = None
+
+# Responses that redirect the request (Apps Script answers a POST with a redirect
+#  to googleusercontent.com from where the response is retrieved by GET)
+_REDIRECTS = [ 301, 302, 303, 307, 308 ]
+_MAX_REDIRECTS = 3
+
+# Errors on a reused connection which show the server closed it while idle
+_CLOSED_ERRORS = [ errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED ]
+
+
+class ConnectionPool(object):
+    """Keeps a persistent (keep-alive) connection to each host for each thread,
+        so the TCP and TLS handshakes are only paid when a connection is opened.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connections(self):
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        return self.local.connections
+
+    def _connection(self, scheme, host):
+        """Returns a tuple of the connection for the host and whether it is being reused."""
+        connections = self._connections()
+        key = (scheme, host)
+        if key in connections:
+            return (connections[key], True)
+        connectionType = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        connection = connectionType(host, timeout=self.timeout)
+        connections[key] = connection
+        Increment("gurgle_sheet_connections_total", labels={ "host": host })
+        _LOGGER.debug("Opening connection to %s (%d opened)", host,
+            GetCounter("gurgle_sheet_connections_total", { "host": host }))
+        return (connection, False)
+
+    def _discard(self, scheme, host):
+        connection = self._connections().pop((scheme, host), None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, method, url, body=None):
+        """Performs the request, following any redirects, returning a tuple of the
+            final status and response body.
+        """
+        for redirect in range(_MAX_REDIRECTS + 1):
+            (scheme, host, path, query, _) = urlsplit(url)
+            path = (path or "/") + ("?" + query if query else "")
+            headers = { "Content-Type": "application/x-www-form-urlencoded" } if body is not None else {}
+            # A reused connection may have been closed by the server while idle,
+            #  in which case the request is repeated on a new connection (but not
+            #  after a timeout, as the server may already have acted on it)
+            while True:
+                (connection, reused) = self._connection(scheme, host)
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read() # always read in full, so the connection can be reused
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    self._discard(scheme, host)
+                    if not reused or not _wasClosed(e):
+                        raise
+            if response.will_close:
+                self._discard(scheme, host)
+            if response.status not in _REDIRECTS:
+                return (response.status, data)
+            url = urljoin(url, response.getheader("location"))
+            if response.status not in [307, 308]:
+                (method, body) = ("GET", None)
+        raise httplib.HTTPException("Too many redirects, last to %s" % url)
+
+def _wasClosed(error):
+    """Returns whether the error shows the request never reached the server, as
+        the connection had been closed.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    if isinstance(error, socket.timeout) or not isinstance(error, socket.error):
+        return False
+    return error.errno in _CLOSED_ERRORS
+
+class CircuitBreaker(object):
+    """Stops sending to the sheet after consecutive failures, allowing a single
+        trial attempt once the cooldown has elapsed (closing again on success).
+    """
+    def __init__(self, failures, cooldown, name="sheet"):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.name = name
+        self.consecutive = 0
+        self.openUntil = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Returns 0 if an attempt is allowed, else the seconds until it will be."""
+        with self.lock:
+            wait = self.openUntil - time.time()
+            if self.failures <= 0 or self.consecutive < self.failures or wait <= 0:
+                if self.consecutive >= self.failures > 0:
+                    # Half-open: permit this trial, holding back others until it completes
+                    self.openUntil = time.time() + self.cooldown
+                return 0
+            return wait
+
+    def waiting(self):
+        """Returns the seconds until an attempt will be allowed (without trying), else 0."""
+        with self.lock:
+            if self.failures <= 0 or self.consecutive < self.failures:
+                return 0
+            return max(self.openUntil - time.time(), 0)
+
+    def success(self):
+        with self.lock:
+            if self.consecutive >= self.failures > 0:
+                _LOGGER.info("Sheet (%s) recovered, resuming sending", self.name)
+            self.consecutive = 0
+
+    def failure(self):
+        with self.lock:
+            self.consecutive += 1
+            if self.consecutive == self.failures:
+                _LOGGER.warning("Sheet (%s) failed %d times in a row, pausing sending for %d seconds",
+                    self.name, self.consecutive, self.cooldown)
+            if self.consecutive >= self.failures > 0:
+                self.openUntil = time.time() + self.cooldown
+
+def Backoff(attempt, base, maximum):
+    """Returns the delay before the retry following the attempt (numbered from 0),
+        as exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+class SenderPool(object):
+    """Bounded queue of updates served by a pool of background sender threads.
+
+    Decouples the (potentially slow) POST to the Google Sheet from the caller,
+    so that the EDDN receive loop continues to drain the relay while updates
+    are being sent. When the queue is full the policy either blocks the caller
+    until space is available, discards the oldest queued update, or holds the
+    update back (keeping only the latest for each system, and at most holdSize)
+    for a dispatcher thread to queue once there is space, so that a slow sheet
+    does not hold up the caller.
+    Failed attempts are scheduled for retry with backoff rather than blocking a
+    worker, and while the circuit breaker is open the workers wait, leaving updates
+    in the queue until it allows an attempt (without using up any of their attempts).
+    Each sender takes up to batchSize waiting updates, sending them in a single POST
+    to the sheet of the lane.
+    """
+    def __init__(self, workers, queueSize, policy, retries, retryWait, retryMaxWait, lane, batchSize=1,
+            holdSize=10000):
+        if policy not in [_POLICY_BLOCK, _POLICY_DROP_OLDEST, _POLICY_HOLD_LATEST]:
+            raise ValueError("Unsupported queue_full policy: %s" % policy)
+        self.workers = workers
+        self.policy = policy
+        self.retries = retries
+        self.retryWait = retryWait
+        self.retryMaxWait = retryMaxWait
+        self.lane = lane
+        self.breaker = lane.breaker
+        self.batchSize = max(batchSize, 1)
+        self.queue = Queue(max(queueSize, 1))
+        self.holdSize = max(holdSize, 1)
+        self.threads = []
+        self.lock = threading.Lock()
+        # Updates held back while the queue is full, by date and system, in the order
+        #  first held (notifying the dispatcher when added, and join when all queued)
+        self.overflow = OrderedDict()
+        self.overflowChanged = threading.Condition()
+        # Heap of (due time, sequence, item) waiting to be retried
+        self.scheduled = []
+        self.sequence = 0
+
+    def start(self):
+        """Starts the worker threads, if not already running."""
+        with self.lock:
+            if len(self.threads) > 0:
+                return
+            for workerNo in range(self.workers):
+                thread = threading.Thread(target=self._run, name="%s-%d" % (self.lane.name, workerNo))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            if self.policy == _POLICY_HOLD_LATEST:
+                thread = threading.Thread(target=self._dispatch, name="%s-dispatch" % self.lane.name)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            _LOGGER.info("Started %d sender(s) for %s with queue size %d (%s when full)",
+                self.workers, self.lane.name, self.queue.maxsize, self.policy)
+
+    def submit(self, snapshot, block=False):
+        """Queues the snapshot for sending, applying the policy if the queue is full
+            (unless blocking regardless of the policy).
+        """
+        self.start()
+        item = [snapshot, 0] # attempts made
+        if block or self.policy == _POLICY_BLOCK:
+            self.queue.put(item)
+            return
+        if self.policy == _POLICY_HOLD_LATEST:
+            self._hold(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.queue.task_done()
+                    _countUpdate("discarded")
+                    _LOGGER.warning("Send queue full, discarded update for %s", dropped[0].starSystem)
+                    Release(dropped[0])
+                except Empty:
+                    pass # consumed by a worker in the meantime, so simply retry
+
+    def _hold(self, item):
+        """Queues the item, unless the queue is full or others are already held back,
+            in which case it is held back in place of any for the same system,
+            discarding the oldest held back if already holding the maximum.
+        """
+        with self.overflowChanged:
+            if len(self.overflow) == 0:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except Full:
+                    _LOGGER.debug("Send queue full for %s, holding back updates", self.lane.name)
+            key = (item[0].eventDate, item[0].starSystem)
+            if key in self.overflow:
+                Increment("gurgle_coalesced_total")
+            elif len(self.overflow) >= self.holdSize:
+                (_, dropped) = self.overflow.popitem(last=False)
+                _countUpdate("discarded")
+                _LOGGER.warning("Send queue full, discarded update for %s", dropped[0].starSystem)
+                Release(dropped[0])
+            self.overflow[key] = item
+            self.overflowChanged.notify_all()
+
+    def _dispatch(self):
+        """Queues the updates held back, oldest first, as space becomes available."""
+        while True:
+            with self.overflowChanged:
+                while len(self.overflow) == 0:
+                    self.overflowChanged.wait()
+                (key, item) = next(self.overflow.iteritems())
+            self.queue.put(item)
+            with self.overflowChanged:
+                # Unless superseded by a later update for the system while being queued
+                if self.overflow.get(key) is item:
+                    del self.overflow[key]
+                if len(self.overflow) == 0:
+                    self.overflowChanged.notify_all()
+
+    def join(self):
+        """Blocks until all queued updates have been processed (including retries)."""
+        with self.overflowChanged:
+            while len(self.overflow) > 0:
+                self.overflowChanged.wait()
+        self.queue.join()
+
+    def _schedule(self, item, delay):
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.scheduled, (time.time() + delay, self.sequence, item))
+
+    def _next(self):
+        """Returns the next item to send, preferring any retry that is due."""
+        while True:
+            with self.lock:
+                now = time.time()
+                if len(self.scheduled) > 0 and self.scheduled[0][0] <= now:
+                    return heapq.heappop(self.scheduled)[2]
+                wait = self.scheduled[0][0] - now if len(self.scheduled) > 0 else 1.0
+            try:
+                # Wake at least every second, as other workers may schedule retries
+                return self.queue.get(timeout=min(wait, 1.0))
+            except Empty:
+                pass
+
+    def _batch(self):
+        """Returns the next item to send, along with any others already waiting."""
+        items = [self._next()]
+        while len(items) < self.batchSize:
+            try:
+                items.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            # Leave the updates in the (bounded) queue while the sheet is failing,
+            #  so that the policy applies once it is full
+            wait = self.breaker.waiting()
+            if wait > 0:
+                time.sleep(min(wait, 1.0))
+                continue
+            items = self._batch()
+            # Each item is marked done (once) when it is finally resolved
+            done = items
+            try:
+                done = self._send(items)
+            except Exception:
+                _LOGGER.exception("Unexpected exception while sending update for %s",
+                    ", ".join([item[0].starSystem for item in items]))
+            finally:
+                for item in done:
+                    self.queue.task_done()
+
+    def _send(self, items):
+        """Attempts to send the items, returning those resolved (rather than
+            scheduled to try again).
+        """
+        # Check the cache again, an equivalent update may have been sent
+        #  while these were waiting in the queue
+        pending = []
+        for item in items:
+            snapshot = item[0]
+            if IsNotInCache(snapshot.eventDate, snapshot.starSystem, snapshot.fingerprint, self.lane.cache):
+                pending.append(item)
+            else:
+                _countUpdate("cached")
+                Acknowledge(snapshot)
+        if len(pending) == 0:
+            return items
+        # Hold back while the sheet is failing, until the breaker allows a trial attempt
+        wait = self.breaker.allow()
+        if wait > 0:
+            for item in pending:
+                self._schedule(item, wait)
+            held = set([id(item) for item in pending])
+            return [item for item in items if id(item) not in held]
+        # Serialised to the form expected by the sheet only now it is being sent, always
+        #  as JSON when batching so each update is formatted the same whatever the batch
+        if self.batchSize == 1:
+            result = SendUpdate(pending[0][0].toUpdate(), self.lane)
         else:
-            _LOGGER.warning("Failed to send update for %s (%.1fly)", starName, distance)
+            result = SendUpdates([item[0].toUpdate() for item in pending], self.lane)
+        if result == _RESULT_SUCCESS:
+            self.breaker.success()
+            for item in pending:
+                _sent(self.lane, item[0])
+            return items
+        scheduled = set()
+        if result == _RESULT_RETRY:
+            self.breaker.failure()
+            for item in pending:
+                item[1] += 1
+                if item[1] < self.retries:
+                    delay = Backoff(item[1] - 1, self.retryWait, self.retryMaxWait)
+                    Increment("gurgle_sheet_retries_total")
+                    _LOGGER.info("(Attempt %d) Retrying update for %s in %.1f seconds", item[1], item[0].starSystem, delay)
+                    self._schedule(item, delay)
+                    scheduled.add(id(item))
+        for item in pending:
+            if id(item) not in scheduled:
+                _failed(self.lane, item[0], result == _RESULT_REJECTED)
+        return [item for item in items if id(item) not in scheduled]
+
+class SheetLane(object):
+    """Route to a single Google Sheet, with its own senders (sending inline if
+        none), circuit breaker and cache, so that a slow or failing sheet does
+        not hold up the updates sent to any other sheet.
+    """
+    def __init__(self, name, url, apiKey, breaker, cache):
+        self.name = name
+        self.url = url
+        self.apiKey = apiKey
+        self.breaker = breaker
+        self.cache = cache
+        self.sender = None
+
+    def submit(self, snapshot, block=False):
+        """Sends the snapshot, in the background if the lane has senders."""
+        if self.sender is not None:
+            self.sender.submit(snapshot, block)
+        else:
+            SendAndCache(snapshot, self)
+
+# Connections kept alive to each sheet (and the host it redirects to)
+_CONNECTIONS = ConnectionPool(__SHEET_TIMEOUT)
+
+# Lane for each sheet, by url (None for the default sheet) and API key
+_LANES = {}
+_LANES_LOCK = threading.Lock()
+
+def _lane(destination):
+    """Returns the lane for the filter Destination, creating it when first used."""
+    key = (destination.url, destination.apiKey)
+    lane = _LANES.get(key)
+    if lane is None:
+        with _LANES_LOCK:
+            lane = _LANES.get(key)
+            if lane is None:
+                lane = _LANES[key] = _createLane(destination)
+    return lane
+
+def _createLane(destination):
+    if destination.url is None:
+        (name, url, apiKey) = ("sheet", __SHEET_URL, __SHEET_API_KEY)
+    else:
+        (name, url, apiKey) = (destination.name, destination.url, destination.apiKey)
+    # Shared by all senders of the lane, so that a failing sheet pauses them all
+    breaker = CircuitBreaker(__SHEET_BREAKER_FAILURES, __SHEET_BREAKER_COOLDOWN, name)
+    lane = SheetLane(name, url, apiKey, breaker, SheetCache(destination.url))
+    if __SHEET_WORKERS > 0:
+        lane.sender = SenderPool(__SHEET_WORKERS, __SHEET_QUEUE_SIZE, _queueFullPolicy or __SHEET_QUEUE_FULL,
+            __SHEET_RETRIES, __SHEET_RETRY_WAIT, __SHEET_RETRY_MAX_WAIT, lane, __SHEET_BATCH_SIZE,
+            __SHEET_HOLD_SIZE)
+    return lane
+
+
+def BlockWhenQueueFull():
+    """Blocks the caller when the send queue is full, whatever the policy configured,
+        for replaying files, where updates held back or discarded would be lost.
+    """
+    global _queueFullPolicy
+    _queueFullPolicy = _POLICY_BLOCK
+
+def _countUpdate(outcome):
+    Increment("gurgle_updates_total", labels={ "outcome": outcome })
+
+def _sent(lane, snapshot):
+    _countUpdate("sent")
+    _LOGGER.info("Processed (sent) update for %s (%.1fly) to %s", snapshot.starSystem, snapshot.distance, lane.name)
+    # Update the Cache Entry (after send so we have definitely sent)
+    CacheUpdate(snapshot.eventDate, snapshot.starSystem, snapshot.fingerprint, lane.cache)
+    Acknowledge(snapshot)
+
+def _failed(lane, snapshot, rejected=False):
+    _countUpdate("failed")
+    Increment("gurgle_sheet_failures_total")
+    _LOGGER.warning("Failed to send update for %s (%.1fly) to %s", snapshot.starSystem, snapshot.distance, lane.name)
+    # Left in the outbox to be resent later, unless the sheet refused it
+    if rejected:
+        Acknowledge(snapshot)
+    else:
+        Release(snapshot)
+
+def Statistics():
+    """Returns the counts of updates sent, failed, already cached, discarded and
+        written only to the local sinks.
+    """
+    return dict([(outcome, GetCounter("gurgle_updates_total", { "outcome": outcome })) for outcome in _OUTCOMES])
+
+def PostUpdate(snapshot):
+    """Responsible for sending the specified SystemSnapshot to the Google Sheet,
+        and writing it to any local output sinks.
+    """
+    # Every snapshot is recorded, as even an unchanged system narrows down the tick
+    RecordSnapshot(snapshot)
+    if _COALESCER is not None:
+        _COALESCER.offer(snapshot)
     else:
-        _LOGGER.debug("Processed (not sent) update for %s (%.1fly)", starName, distance)
+        _postUpdate(snapshot)
 
-def SendUpdate(dictionary):
-    """Posts the specified dictionary to the Google Sheet.
+def _postUpdate(snapshot):
+    starName = snapshot.starSystem
+    eventDate = snapshot.eventDate
+    if not SHEET_ENABLED:
+        # Only written locally (if Cache says we need to), so nothing further to wait for
+        if IsNotInCache(eventDate, starName, snapshot.fingerprint):
+            WriteUpdate(snapshot)
+            _countUpdate("written")
+            CacheUpdate(eventDate, starName, snapshot.fingerprint)
+        else:
+            _countUpdate("cached")
+            _LOGGER.debug("Processed (not written) update for %s (%.1fly)", starName, snapshot.distance)
+        return
+    written = False
+    for (destination, distance) in snapshot.routes:
+        lane = _lane(destination)
+        # Send the update to each sheet, if the Cache of that sheet says we need to
+        if IsNotInCache(eventDate, starName, snapshot.fingerprint, lane.cache):
+            if not written:
+                WriteUpdate(snapshot)
+                written = True
+            routed = snapshot.routed(destination, distance)
+            # Written to the outbox first, so that it is resent if it cannot be sent now
+            WriteAhead(routed)
+            lane.submit(routed)
+        else:
+            _countUpdate("cached")
+            _LOGGER.debug("Processed (not sent) update for %s (%.1fly) to %s", starName, distance, lane.name)
 
-    To be successful we need to provide an appropriate API_KEY value, and we also
-    want to retry any infrastructure errors (i.e. unable to complete the POST) but
-    abandon the entire process if the "application" does not report success (i.e.
-    on an invalid token, badly formed request, etc.).
+def FlushUpdates():
+    """Blocks until any updates queued by PostUpdate have been processed."""
+    if _COALESCER is not None:
+        _COALESCER.flush()
+    for lane in _LANES.values():
+        if lane.sender is not None:
+            lane.sender.join()
+    FlushSinks()
+
+# Coalescing stage used by PostUpdate, if configured to hold updates
+_COALESCER = None
+if __COALESCE_WINDOW > 0:
+    _COALESCER = Coalescer(__COALESCE_WINDOW, __COALESCE_MAX_DELAY, _postUpdate)
+
+def SendAndCache(snapshot, lane):
+    """Sends the snapshot to the sheet of the lane and, only once successful,
+        records it in the cache.
+
+    Used when sending inline (without background senders), so any backoff
+    between attempts (or wait while the circuit breaker is open, which does not
+    use up an attempt) necessarily blocks the caller.
     """
-    dictionary['API_KEY'] = __SHEET_API_KEY
-    data = urlencode(dictionary)
-    retries = __SHEET_RETRIES
-    success = 0
-    response = None
-    while success != 200 and retries > 0:
-        try:
-            request = urlopen(__SHEET_URL, data, __SHEET_TIMEOUT)
-            success = request.getcode()
-            response = request.read(__SHEET_RESPONSE_BUFFER)
-            request.close()
-        except Exception, e:
-            _LOGGER.info("(Retry %d) Exception while attempting to POST data: %s", retries, str(e))
-            retries -= 1
-            if retries > 0:
-                time.sleep(__SHEET_RETRY_WAIT)
+    update = snapshot.toUpdate()
+    result = None
+    attempt = 0
+    while attempt < __SHEET_RETRIES:
+        wait = lane.breaker.allow()
+        if wait > 0:
+            time.sleep(wait)
+            continue
+        result = SendUpdate(update, lane)
+        if result == _RESULT_SUCCESS:
+            lane.breaker.success()
+            _sent(lane, snapshot)
+            return
+        if result == _RESULT_REJECTED:
+            break
+        lane.breaker.failure()
+        attempt += 1
+        if attempt < __SHEET_RETRIES:
+            Increment("gurgle_sheet_retries_total")
+            time.sleep(Backoff(attempt - 1, __SHEET_RETRY_WAIT, __SHEET_RETRY_MAX_WAIT))
+    _failed(lane, snapshot, result == _RESULT_REJECTED)
+
+def ResendUpdate(snapshot):
+    """Sends the update held by the outbox (in the same way as PostUpdate, but
+        without writing it to the local sinks again), returning False without
+        sending it while the circuit breaker of its sheet is open.
+    """
+    destination = FindDestination(snapshot.sheet)
+    if destination is None:
+        _LOGGER.warning("Discarded update for %s as its sheet is no longer configured: %s",
+            snapshot.starSystem, snapshot.sheet)
+        Acknowledge(snapshot)
+        return True
+    lane = _lane(destination)
+    if lane.breaker.waiting() > 0:
+        return False
+    if not IsNotInCache(snapshot.eventDate, snapshot.starSystem, snapshot.fingerprint, lane.cache):
+        _countUpdate("cached")
+        Acknowledge(snapshot)
+    else:
+        lane.submit(snapshot, block=True)
+    return True
+
+def SendUpdate(dictionary, lane=None):
+    """Posts the specified dictionary to the Google Sheet (of the lane, else the
+        default sheet), in a single attempt.
+
+    To be successful we need to provide an appropriate API_KEY value. Returns
+    whether the attempt succeeded, should be retried (infrastructure errors, i.e.
+    unable to complete the POST, or the sheet reporting an error) or should be
+    abandoned as the "application" refused it (i.e. on an invalid token, badly
+    formed request, etc.).
+    """
+    (url, apiKey) = (lane.url, lane.apiKey) if lane is not None else (__SHEET_URL, __SHEET_API_KEY)
+    data = urlencode(dict(dictionary, API_KEY=apiKey))
+    return _post(url, data, dictionary.get("StarSystem"))
+
+def SendUpdates(dictionaries, lane=None):
+    """Posts the specified dictionaries to the Google Sheet (of the lane, else the
+        default sheet) as a batch of rows, in a single attempt, returning the
+        result as for SendUpdate.
+    """
+    (url, apiKey) = (lane.url, lane.apiKey) if lane is not None else (__SHEET_URL, __SHEET_API_KEY)
+    data = urlencode({ "API_KEY": apiKey, "rows": json.dumps(dictionaries) })
+    return _post(url, data, "%d updates" % len(dictionaries))
+
+def _post(url, data, description):
+    started = time.time()
+    try:
+        (status, response) = _CONNECTIONS.request("POST", url, data)
+    except Exception, e:
+        Observe("gurgle_sheet_send_seconds", time.time() - started)
+        _LOGGER.info("Exception while attempting to POST data: %s", str(e))
+        return _RESULT_RETRY
+    duration = time.time() - started
+    Observe("gurgle_sheet_send_seconds", duration)
+    _LOGGER.debug("POST for %s completed with %d in %.3f seconds", description, status, duration)
+    if status != 200:
+        _LOGGER.info("Unexpected status %d from Sheet: %s", status, response[:__SHEET_RESPONSE_BUFFER])
+        return _RESULT_RETRY
     # Check the response for validity, where "result"="success"
-    if success == 200 and response is not None:
-        try:
-            result = json.loads(response) # Throws Exception if JSON not returned
-            if (result["result"] != "success"):
-                raise Exception("Bad response from Sheet: %s" % result)
-            _LOGGER.debug("Success Response: %s" % result)
-        except:
-            _LOGGER.warning("Unexpected response from Sheet: %s", response)
-    return (success == 200)
+    try:
+        result = json.loads(response) # Throws Exception if JSON not returned
+    except ValueError:
+        _LOGGER.warning("Unexpected response from Sheet: %s", response[:__SHEET_RESPONSE_BUFFER])
+        return _RESULT_RETRY
+    if result.get("result") == "success":
+        _LOGGER.debug("Success Response: %s" % result)
+        return _RESULT_SUCCESS
+    _LOGGER.warning("Bad response from Sheet: %s", result)
+    # Errors (i.e. quota or lock timeouts) may succeed later, unlike invalid requests
+    return _RESULT_RETRY if result.get("result") == "error" else _RESULT_REJECTED
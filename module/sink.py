@@ -0,0 +1,158 @@
+"""Provides local output sinks that record updates alongside (or instead of) the Google Sheet."""
+from config import Config
+import atexit
+import csv
+import json
+import sqlite3
+import threading
+import time
+from os.path import getsize, isfile
+
+# Logger instance used by the functions in this module
+_LOGGER = Config.getLogger("sink")
+
+# Configuration for the output destinations, where "sheet" is the Google Sheet
+_OUTPUT_SINKS = Config.getString('output', 'sinks', 'sheet')
+_OUTPUT_BATCH_SIZE = Config.getInteger('output', 'batch_size', 500)
+_OUTPUT_FLUSH_INTERVAL = Config.getInteger('output', 'flush_interval', 5)
+
+# Defines the columns written by the local sinks, matching the Google Sheet layout
+_SYSTEM_COLUMNS = ["Timestamp", "EventDate", "EventTime", "StarSystem", "LocationX", "LocationY", "LocationZ",
+    "Distance", "SystemSecurity", "SystemAllegiance", "SystemGovernment", "SystemEconomy", "Population", "SystemFaction"]
+_FACTION_COLUMNS = ["Name", "Influence", "State", "PendingState", "RecoveringState", "Allegiance", "Government"]
+_MAX_FACTIONS = 10
+COLUMNS = _SYSTEM_COLUMNS + ["Faction%d%s" % (factionNo, column)
+    for factionNo in range(1, _MAX_FACTIONS+1) for column in _FACTION_COLUMNS]
+
+
+class OutputSink(object):
+    """Buffers updates and writes them in batches, when the batch is full or the
+        flush interval has elapsed since the last write.
+    """
+    def __init__(self, name, batchSize, flushInterval):
+        self.name = name
+        self.batchSize = max(batchSize, 1)
+        self.flushInterval = flushInterval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.lastFlush = time.time()
+
+    def write(self, update):
+        """Buffers the update, flushing if the batch is full."""
+        with self.lock:
+            self.buffer.append(self.format(update))
+            if len(self.buffer) >= self.batchSize:
+                self._flush()
+
+    def flush(self, force=True):
+        """Writes any buffered updates (if forced or the flush interval has elapsed)."""
+        with self.lock:
+            if force or time.time() - self.lastFlush >= self.flushInterval:
+                self._flush()
+
+    def _flush(self):
+        rows = self.buffer
+        self.buffer = []
+        self.lastFlush = time.time()
+        if len(rows) > 0:
+            try:
+                self.writeRows(rows)
+                _LOGGER.debug("Wrote %d updates to %s", len(rows), self.name)
+            except Exception:
+                _LOGGER.exception("Failed to write %d updates to %s", len(rows), self.name)
+
+    def format(self, update):
+        """Returns the update in the form buffered by the sink."""
+        return [update.get(column, "") for column in COLUMNS]
+
+    def writeRows(self, rows):
+        raise NotImplementedError()
+
+class CsvSink(OutputSink):
+    """Appends updates to a CSV file, with the column titles as the first row."""
+    def __init__(self, fileName, batchSize, flushInterval):
+        super(CsvSink, self).__init__(fileName, batchSize, flushInterval)
+        self.fileName = fileName
+        if not isfile(fileName) or getsize(fileName) == 0:
+            self.writeRows([COLUMNS])
+
+    def format(self, update):
+        # Python 2 csv requires encoded strings
+        return [value.encode("utf-8") if isinstance(value, unicode) else value
+            for value in super(CsvSink, self).format(update)]
+
+    def writeRows(self, rows):
+        with open(self.fileName, "ab") as file:
+            csv.writer(file).writerows(rows)
+
+class JsonLinesSink(OutputSink):
+    """Appends updates to a file, one JSON object per line."""
+    def __init__(self, fileName, batchSize, flushInterval):
+        super(JsonLinesSink, self).__init__(fileName, batchSize, flushInterval)
+        self.fileName = fileName
+
+    def format(self, update):
+        return json.dumps(update, sort_keys=True)
+
+    def writeRows(self, rows):
+        with open(self.fileName, "a") as file:
+            file.write("\n".join(rows) + "\n")
+
+class SQLiteSink(OutputSink):
+    """Inserts updates into an SQLite table, one transaction per batch."""
+    def __init__(self, fileName, batchSize, flushInterval):
+        super(SQLiteSink, self).__init__(fileName, batchSize, flushInterval)
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        columns = ", ".join(['"%s"' % column for column in COLUMNS])
+        self.connection.execute("CREATE TABLE IF NOT EXISTS updates (%s)" % columns)
+        self.connection.commit()
+        self.insert = "INSERT INTO updates (%s) VALUES (%s)" % (columns, ", ".join(["?"] * len(COLUMNS)))
+
+    def writeRows(self, rows):
+        with self.connection:
+            self.connection.executemany(self.insert, rows)
+
+# Local sinks that can be configured, with the default file used by each
+_SINK_TYPES = { "csv": (CsvSink, "logs/updates.csv"), "jsonl": (JsonLinesSink, "logs/updates.jsonl"),
+    "sqlite": (SQLiteSink, "logs/updates.db") }
+
+def InitialiseSinks():
+    """Returns a tuple of whether the Google Sheet is enabled and the list of local sinks."""
+    sheet = False
+    sinks = []
+    for name in [name.strip() for name in _OUTPUT_SINKS.split(",") if len(name.strip()) > 0]:
+        if name == "sheet":
+            sheet = True
+        elif name in _SINK_TYPES:
+            (sinkType, defaultFile) = _SINK_TYPES[name]
+            fileName = Config.getString('output', name, defaultFile)
+            sinks.append(sinkType(fileName, _OUTPUT_BATCH_SIZE, _OUTPUT_FLUSH_INTERVAL))
+            _LOGGER.info("Configured %s output to %s", name, fileName)
+        else:
+            raise ValueError("Unsupported output sink: %s" % name)
+    return (sheet, sinks)
+(SHEET_ENABLED, _SINKS) = InitialiseSinks()
+
+def _flushPeriodically():
+    while True:
+        time.sleep(max(_OUTPUT_FLUSH_INTERVAL, 1))
+        for sink in _SINKS:
+            sink.flush(force=False)
+
+if len(_SINKS) > 0 and _OUTPUT_FLUSH_INTERVAL > 0:
+    _FLUSHER = threading.Thread(target=_flushPeriodically, name="sink-flush")
+    _FLUSHER.daemon = True
+    _FLUSHER.start()
+
+def WriteUpdate(snapshot):
+    """Writes the snapshot to each of the local sinks."""
+    if len(_SINKS) > 0:
+        update = snapshot.toUpdate()
+        for sink in _SINKS:
+            sink.write(update)
+
+def FlushSinks():
+    """Writes any updates buffered by the local sinks."""
+    for sink in _SINKS:
+        sink.flush()
+atexit.register(FlushSinks)
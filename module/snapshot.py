@@ -0,0 +1,122 @@
+"""Provides the compact model of the system and faction state extracted from each
+    event, which is only serialised to the form expected by the Google Sheet (and
+    the local sinks) when it is sent.
+"""
+from operator import attrgetter
+import hashlib
+
+# Shared instances of the names and states seen, so that each snapshot refers to
+#  the same string rather than holding its own copy decoded from the message
+_INTERNED = {}
+
+def Intern(value):
+    """Returns the shared instance of the (str or unicode) value."""
+    return _intern(value, value)
+_intern = _INTERNED.setdefault
+
+# Defines the columns for each faction, in the order held by FactionState
+_FACTION_COLUMNS = ("Name", "Influence", "State", "PendingState", "RecoveringState", "Allegiance", "Government")
+_FACTION_KEYS = []
+
+def FactionKeys(factionNo):
+    """Returns the tuple of column keys for the faction (numbered from 1)."""
+    while len(_FACTION_KEYS) < factionNo:
+        prefix = "Faction%d" % (len(_FACTION_KEYS) + 1)
+        _FACTION_KEYS.append(tuple([prefix + column for column in _FACTION_COLUMNS]))
+    return _FACTION_KEYS[factionNo - 1]
+
+
+class FactionState(object):
+    """Influence and states of a single faction within a system."""
+    __slots__ = ("name", "influence", "state", "pendingState", "recoveringState", "allegiance", "government")
+
+    def __init__(self, faction):
+        get = faction.get
+        self.name = Intern(faction["Name"])
+        self.influence = float(faction["Influence"])
+        self.state = Intern(get("FactionState", ""))
+        # Since the sheet expects either all information or none for each faction
+        #  the states are always specified, even if not present
+        states = get("PendingStates")
+        self.pendingState = _states(states) if states else ""
+        states = get("RecoveringStates")
+        self.recoveringState = _states(states) if states else ""
+        self.allegiance = Intern(get("Allegiance", ""))
+        self.government = Intern(get("Government", ""))
+
+    def values(self):
+        """Returns the values in the order of the faction columns."""
+        return (self.name, self.influence, self.state, self.pendingState, self.recoveringState,
+            self.allegiance, self.government)
+
+def _states(states):
+    return Intern(",".join([state["State"] for state in states]))
+
+def _sortedStates(states):
+    return ",".join(sorted(states.split(","))) if "," in states else states
+
+def Fingerprint(factions):
+    """Returns a compact fingerprint of the faction names, influence and states."""
+    values = []
+    for faction in sorted(factions, key=attrgetter("name")):
+        values.append(faction.name)
+        values.append("%.6f" % faction.influence)
+        values.append(faction.state)
+        values.append(_sortedStates(faction.pendingState))
+        values.append(_sortedStates(faction.recoveringState))
+    return hashlib.sha1(u"\x1f".join(values).encode("utf-8")).hexdigest()[0:16]
+
+
+class SystemSnapshot(object):
+    """State of a system and its factions reported by a single event.
+
+    The factions are those reported to the sheet, in descending influence, while
+    the fingerprint (computed once on creation) covers all of the factions.
+    The routes are the (destination, distance) of each sheet the system is sent
+    to, where the distance is from the location of that destination, and sheet
+    is the url of the sheet (None for the default sheet) once routed to one.
+    """
+    __slots__ = ("timestamp", "eventDate", "eventTime", "starSystem", "x", "y", "z", "distance",
+        "security", "allegiance", "government", "economy", "population", "systemFaction",
+        "factions", "fingerprint", "routes", "sheet")
+
+    def __init__(self, timestamp, starSystem, position, distance, factions, fingerprint):
+        self.timestamp = timestamp
+        self.eventDate = timestamp[0:10]
+        self.eventTime = timestamp[11:19]
+        self.starSystem = Intern(starSystem)
+        (self.x, self.y, self.z) = position
+        self.distance = distance
+        self.security = ""
+        self.allegiance = ""
+        self.government = ""
+        self.economy = ""
+        self.population = ""
+        self.systemFaction = ""
+        self.factions = factions
+        self.fingerprint = fingerprint
+        self.routes = ()
+        self.sheet = None
+
+    def routed(self, destination, distance):
+        """Returns the snapshot as sent to the destination, with its distance."""
+        if destination.url is None and distance == self.distance:
+            return self
+        snapshot = SystemSnapshot.__new__(SystemSnapshot)
+        for name in SystemSnapshot.__slots__:
+            setattr(snapshot, name, getattr(self, name))
+        snapshot.distance = distance
+        snapshot.routes = ((destination, distance),)
+        snapshot.sheet = destination.url
+        return snapshot
+
+    def toUpdate(self):
+        """Returns the dictionary posted to the Google Sheet."""
+        update = { "Timestamp": self.timestamp, "EventDate": self.eventDate, "EventTime": self.eventTime,
+            "StarSystem": self.starSystem, "LocationX": self.x, "LocationY": self.y, "LocationZ": self.z,
+            "Distance": self.distance, "SystemSecurity": self.security, "SystemAllegiance": self.allegiance,
+            "SystemGovernment": self.government, "SystemEconomy": self.economy,
+            "Population": self.population, "SystemFaction": self.systemFaction }
+        for factionNo, faction in enumerate(self.factions, 1):
+            update.update(zip(FactionKeys(factionNo), faction.values()))
+        return update